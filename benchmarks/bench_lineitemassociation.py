@@ -0,0 +1,66 @@
+"""
+micro-benchmark of matching rows to lineitems/creatives/LICAs in setup_lineitemassociation
+
+$ pipenv run python -m benchmarks.bench_lineitemassociation
+"""
+from timeit import timeit
+
+from gasp.admanager import association_pairs, group_by, index_by
+
+ROWS = 10_000
+ORDERS = 20
+
+
+def synthetic():
+    lineitem_rows = [{"order_name": f"order{i % ORDERS}", "name": f"lineitem{i}"} for i in range(ROWS)]
+    creative_rows = [
+        {"order_name": r["order_name"], "lineitem_name": r["name"], "name": f"creative{i}"}
+        for i, r in enumerate(lineitem_rows)
+    ]
+    lineitems = [{"id": i, "name": r["name"], "order_name": r["order_name"]} for i, r in enumerate(lineitem_rows)]
+    creatives = [{"id": i, "name": r["name"]} for i, r in enumerate(creative_rows)]
+    # half of them are already associated
+    licas = [{"lineItemId": i, "creativeId": i} for i in range(0, ROWS, 2)]
+    return lineitem_rows, creative_rows, lineitems, creatives, licas
+
+
+def scan(lineitem_rows, creative_rows, lineitems, creatives, licas):
+    to_creates = []
+    for order_name in {r["order_name"] for r in lineitem_rows}:
+        lineitems_in_order = list(filter(lambda l: l["order_name"] == order_name, lineitems))
+        rows = list(filter(lambda r: r["order_name"] == order_name, creative_rows))
+        settings = []
+        for row in rows:
+            lineitem = next(filter(lambda l: l["name"] == row["lineitem_name"], lineitems_in_order))
+            creative = next(filter(lambda c: c["name"] == row["name"], creatives))
+            settings.append({"lineItemId": lineitem["id"], "creativeId": creative["id"]})
+        for s in settings:
+            if not any(e["lineItemId"] == s["lineItemId"] and e["creativeId"] == s["creativeId"] for e in licas):
+                to_creates.append(s)
+    return to_creates
+
+
+def indexed(lineitem_rows, creative_rows, lineitems, creatives, licas):
+    to_creates = []
+    creative_rows_by_order = group_by("order_name", creative_rows)
+    lineitems_by_order = group_by("order_name", lineitems)
+    creative_by_name = index_by("name", creatives)
+    existing = association_pairs(licas)
+    for order_name, rows in creative_rows_by_order.items():
+        lineitem_by_name = index_by("name", lineitems_by_order[order_name])
+        settings = []
+        for row in rows:
+            lineitem = lineitem_by_name[row["lineitem_name"]]
+            creative = creative_by_name[row["name"]]
+            settings.append({"lineItemId": lineitem["id"], "creativeId": creative["id"]})
+        to_creates.extend(filter(lambda s: (s["lineItemId"], s["creativeId"]) not in existing, settings))
+    return to_creates
+
+
+if __name__ == "__main__":
+    data = synthetic()
+    assert sorted(map(lambda s: s["lineItemId"], scan(*data))) == sorted(
+        map(lambda s: s["lineItemId"], indexed(*data))
+    )
+    for f in [scan, indexed]:
+        print(f"{f.__name__}: {timeit(lambda: f(*data), number=1):.3f}s ({ROWS} rows, {ORDERS} orders)")
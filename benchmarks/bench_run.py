@@ -0,0 +1,115 @@
+"""
+end-to-end benchmark of gasp.runner.run against the fakes in gasp.fake
+
+$ pipenv run python -m benchmarks.bench_run --latency=0.01 --sizes=100,1000,10000
+"""
+import json
+import os
+import tempfile
+from optparse import OptionParser
+from time import perf_counter
+
+from gasp.fake import FakeAdManagerClient, FakeSpreadsheets
+from gasp.runner import run
+
+LINEITEMS_PER_ORDER = 100
+
+CONFIG = {
+    "ad_manager": {
+        "network_code": "12345",
+        "currency_code": "JPY",
+        "rate_limit": {"requests_per_second": 1000, "burst": 1000},
+    },
+    "journal": {"path": os.path.join(tempfile.gettempdir(), "gasp_benchmark_journal.jsonl")},
+    "spreadsheet": {
+        "id": "benchmark",
+        "sheets": {
+            "order": {
+                "sheet_name": "Order",
+                "columns": {"name": "Name", "advertiser_name": "Advertiser", "trafficker_name": "User"},
+            },
+            "lineitem": {
+                "sheet_name": "LineItem",
+                "columns": {
+                    "order_name": "Order Name",
+                    "name": "Name",
+                    "sizes": "Size",
+                    "costPerUnit": "CPM",
+                    "targetingUnit": "AdUnitId",
+                    "targetingKeyValue1": "KV1",
+                },
+            },
+            "creative": {
+                "sheet_name": "Creative",
+                "columns": {
+                    "order_name": "Order Name",
+                    "lineitem_name": "LineItem Name",
+                    "name": "Name",
+                    "snippet": "Code",
+                },
+            },
+        },
+    },
+    "key": "./key.json",
+}
+
+
+def campaign(lineitems, latency):
+    """
+    returns (client, sheets) of a header bidding campaign, orders exist but nothing else is created yet
+    """
+    client = FakeAdManagerClient(latency=latency)
+    advertiser = client.add("companies", name="Advertiser")
+    trafficker = client.add("users", name="Trafficker")
+    key = client.add("keys", name="hb_pb")
+
+    orders = [f"order{i}" for i in range((lineitems - 1) // LINEITEMS_PER_ORDER + 1)]
+    for name in orders:
+        client.add("orders", name=name, advertiserId=advertiser["id"], traffickerId=trafficker["id"])
+
+    order_sheet = [["Name", "Advertiser", "User"]] + [[name, "Advertiser", "Trafficker"] for name in orders]
+    lineitem_sheet = [["Order Name", "Name", "Size", "CPM", "AdUnitId", "KV1"]]
+    creative_sheet = [["Order Name", "LineItem Name", "Name", "Code"]]
+    for i in range(lineitems):
+        order, price = orders[i // LINEITEMS_PER_ORDER], f"{i / 100:.2f}"
+        client.add("values", name=price, customTargetingKeyId=key["id"])
+        lineitem_sheet.append([order, f"hb_{price}", "300x250", i + 1, "1234", f"hb_pb={price}"])
+        creative_sheet.append([order, f"hb_{price}", f"hb_{price}_300x250", "<script></script>"])
+
+    sheets = FakeSpreadsheets({"Order": order_sheet, "LineItem": lineitem_sheet, "Creative": creative_sheet}, latency)
+    return client, sheets
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--sizes", type="string", dest="sizes", default="100,1000,10000")
+    parser.add_option("--latency", type="float", dest="latency", default=0.0, help="seconds per API call")
+    parser.add_option("--workers", type="int", dest="workers", default=1)
+    parser.add_option("--plan", action="store_true", dest="plan", default=False)
+    parser.add_option("--pipeline", action="store_true", dest="pipeline", default=False)
+    options, _ = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config_path = os.path.join(tmp, "config.json")
+        with open(config_path, "w") as f:
+            json.dump(CONFIG, f)
+
+        for size in map(int, options.sizes.split(",")):
+            client, sheets = campaign(size, options.latency)
+            start = perf_counter()
+            run(
+                config_path,
+                workers=options.workers,
+                plan=options.plan,
+                pipeline=options.pipeline,
+                client=client,
+                sheets_api=sheets,
+            )
+            elapsed = perf_counter() - start
+
+            calls = sum(client.calls.values()) + sum(sheets.calls.values())
+            print(f"{size} lineitems: {elapsed:.2f}s, {calls} API calls")
+            for (service, method), count in client.calls.most_common():
+                print(f"  {service}.{method}: {count}")
+            for method, count in sheets.calls.most_common():
+                print(f"  spreadsheets.{method}: {count}")
@@ -0,0 +1,61 @@
+"""
+cold start and per call overhead of building SOAP services, needs a real config and key
+each arm gets its own empty WSDL cache, so neither warms the cache of the other
+
+$ pipenv run python -m benchmarks.bench_services --config=config.json
+"""
+import os
+import tempfile
+from optparse import OptionParser
+from time import perf_counter
+
+import googleads.ad_manager as ad_manager
+import zeep.cache
+
+from gasp.admanager import API_VERSION, AdManager
+from gasp.config import Config
+
+SERVICES = [
+    "CompanyService",
+    "UserService",
+    "OrderService",
+    "LineItemService",
+    "CreativeService",
+    "CustomTargetingService",
+    "LineItemCreativeAssociationService",
+]
+CALLS = 20
+
+
+def measure(get_service):
+    start = perf_counter()
+    [get_service(name) for name in SERVICES]
+    cold = perf_counter() - start
+
+    start = perf_counter()
+    [get_service(name) for _ in range(CALLS) for name in SERVICES]
+    per_call = (perf_counter() - start) / (CALLS * len(SERVICES))
+    return cold, per_call
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--config", type="string", dest="config_path")
+    options, _ = parser.parse_args()
+    config = Config(options.config_path)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # before: GetService on every lookup with the default WSDL cache of googleads (zeep SqliteCache, one hour)
+        client = ad_manager.AdManagerClient.LoadFromString(AdManager.setting_yaml_string(config))
+        client.cache = zeep.cache.SqliteCache(path=os.path.join(tmp, "before.sqlite3"))
+        cold, per_call = measure(lambda name: client.GetService(name, version=API_VERSION))
+        print(f"GetService per call: cold start {cold:.2f}s, {per_call * 1000:.1f}ms per call")
+
+        # after: services are built once, WSDLs come from the disk cache from the second run
+        config.data.setdefault("ad_manager", {})["wsdl_cache"] = {
+            "path": os.path.join(tmp, "after.sqlite3"),
+            "ttl": config.get_or_default("ad_manager.wsdl_cache.ttl"),
+        }
+        for run in ["first run", "second run"]:
+            cold, per_call = measure(AdManager(config).service)
+            print(f"AdManager.service ({run}): cold start {cold:.2f}s, {per_call * 1000:.3f}ms per call")
@@ -0,0 +1,46 @@
+"""
+benchmark of validating lineitem rows in Spreadsheet.check_lineitems
+
+$ pipenv run python -m benchmarks.bench_validation
+"""
+from timeit import timeit
+
+from jsonschema import validate
+
+from gasp.spreadsheet import Spreadsheet, lineitem_validator
+
+ROWS = 50_000
+ORDERS = 100
+
+
+def synthetic():
+    orders = [{"name": f"order{i}"} for i in range(ORDERS)]
+    lineitems = [
+        {
+            "order_name": f"order{i % ORDERS}",
+            "name": f"lineitem{i}",
+            "sizes": "300x250",
+            "costPerUnit": i % 1000 + 1,
+            "targetingUnit": "1234,5678",
+            "targetingKeyValue1": f"hb_pb={i % 1000}",
+        }
+        for i in range(ROWS)
+    ]
+    return lineitems, orders
+
+
+def per_row_validate(lineitems, orders):
+    order_names = list(set(map(lambda o: o["name"], orders)))
+    properties = {**lineitem_validator.schema["properties"], "order_name": {"type": "string", "enum": order_names}}
+    schema = {**lineitem_validator.schema, "properties": properties}
+    [validate(li, schema) for li in lineitems]
+
+
+def compiled(lineitems, orders):
+    assert Spreadsheet.check_lineitems(None, lineitems, orders) == []
+
+
+if __name__ == "__main__":
+    data = synthetic()
+    for f in [per_row_validate, compiled]:
+        print(f"{f.__name__}: {timeit(lambda: f(*data), number=1):.3f}s ({ROWS} rows, {ORDERS} orders)")
@@ -1,60 +1,322 @@
 import functools
 import logging
+import random
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pformat
-from time import sleep
+from time import monotonic, sleep
 
 import googleads.ad_manager as ad_manager
 import yaml
 import zeep
+import zeep.cache
+from googleads.errors import GoogleAdsServerFault
 from more_itertools import chunked
 
+from gasp.cache import LRUCache, PersistentCache
+from gasp.compare import (
+    LINEITEM_IGNORED_FIELDS,
+    apply_differences,
+    canonical_custom_targeting,
+    compare_objects,
+    differences,
+    normalize,
+)
+from gasp.instrument import Recorder, count_items
+
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 API_VERSION = "v202008"
 
+# max objects per page of getXxxByStatement
+PAGE_SIZE = 500
+# max values bound into a single IN clause
+IN_CLAUSE_SIZE = 200
+
+# faults which succeed by retrying later
+RETRYABLE_ERRORS = [
+    "QuotaError.EXCEEDED_QUOTA",
+    "ServerError.SERVER_BUSY",
+    "ServerError.SERVER_ERROR",
+    "CommonError.CONCURRENT_MODIFICATION",
+]
+# faults on a write which guarantee that nothing has been applied
+REJECTED_WRITE_ERRORS = ["QuotaError.EXCEEDED_QUOTA", "CommonError.CONCURRENT_MODIFICATION"]
+# writes which are safe to send again after a server error,
+# updates overwrite the same fields and a duplicated LICA is rejected as NOT_UNIQUE
+IDEMPOTENT_WRITE_PREFIXES = ("update", "createLineItemCreativeAssociations")
+# faults on an item which means it has been created already
+DUPLICATE_ERRORS = ["UniqueError.NOT_UNIQUE", "CommonError.ALREADY_EXISTS", "CommonError.DUPLICATE_OBJECT"]
+# methods which are throttled by the rate limit
+WRITE_METHOD_PREFIXES = ("create", "update", "perform")
+
+TARGETING_KEYVALUE_COLUMNS = ["targetingKeyValue" + str(n) for n in range(1, 12 + 1)]
+
+
+def group_by(key, rows):
+    """
+    group rows into {row[key]: [row, ...]} keeping the order of rows
+    """
+    groups = {}
+    for row in rows:
+        groups.setdefault(row[key], []).append(row)
+    return groups
+
 
-def memoize(obj):
-    cache = obj.cache = {}
+def index_by(key, objects):
+    return {o[key]: o for o in objects}
 
-    @functools.wraps(obj)
-    def memoizer(*args):
-        if args not in cache:
-            cache[args] = obj(*args)
-        return cache[args]
 
-    return memoizer
+def association_pairs(associations):
+    return {(a["lineItemId"], a["creativeId"]) for a in associations}
 
 
-def compare_objects(key, settings: list, existing: list, key_only=False):
+def lineitem_sizes(lineitem_rows):
     """
-    compare settings to existing by key
-    and returns
-    {
-        notfound: [...],
-        different: [...],
-        existing: [...],
-    }
+    {(order_name, lineitem name): sizes}, lineitem names are unique only in each order
     """
-    returns = {"notfound": [], "different": [], "existing": []}
-    existing_map = {e[key]: e for e in existing}
-    for s in settings:
-        rel = s[key]
-        if rel in existing_map:
-            if key_only is True or is_containing(s, existing_map[rel]):
-                returns["existing"].append(s)
-            else:
-                returns["different"].append(s)
+    return {(li["order_name"], li["name"]): li["sizes"] for li in lineitem_rows}
+
+
+@functools.lru_cache(maxsize=None)
+def parse_sizes(sizes):
+    """
+    "300x250, 728x90" -> ((300, 250), (728, 90))
+    the same string returns the same tuple, so lineitems and creatives share one parsed size table
+    """
+    return tuple(tuple(map(int, size.strip().split("x"))) for size in sizes.split(","))
+
+
+def size_config(size):
+    width, height = size
+    return {"width": width, "height": height, "isAspectRatio": False}
+
+
+def association_config(lineitem_id, creative_id, sizes):
+    """
+    a creative has the first size of the lineitem, other sizes are given by the size override of the LICA
+    """
+    setting = {"lineItemId": lineitem_id, "creativeId": creative_id}
+    if 1 < len(parse_sizes(sizes)):
+        setting["sizes"] = list(map(size_config, parse_sizes(sizes)))
+    return setting
+
+
+def association_settings(creative_rows, lineitem_ids, creative_ids, lineitem_to_sizes):
+    """
+    LICA settings of creative rows in an order
+    lineitem_ids: {lineitem name: id} of the order, creative_ids: {creative name: id}
+    """
+    settings = []
+    for row in creative_rows:
+        lineitem_id, creative_id = lineitem_ids[row["lineitem_name"]], creative_ids[row["name"]]
+        sizes = lineitem_to_sizes[(row["order_name"], row["lineitem_name"])]
+        settings.append(association_config(lineitem_id, creative_id, sizes))
+    return settings
+
+
+def run_per_order(order_rows, setup_order, workers=1):
+    """
+    returns {order name: setup_order(order_row)}, orders run concurrently with workers > 1
+    an error of an order does not stop the others, errors are reported after all orders finished
+    """
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = [(o["name"], executor.submit(setup_order, o)) for o in order_rows]
+
+    results, errors = {}, []
+    for name, future in futures:
+        error = future.exception()
+        if error is None:
+            results[name] = future.result()
         else:
-            returns["notfound"].append(s)
-    return returns
+            logger.error(f"order {name}: {error!r}")
+            errors.append((name, error))
+    if 0 < len(errors):
+        raise ProvisioningFailed(
+            f"provisioning failed in {len(errors)}/{len(order_rows)} orders:\n"
+            + "\n".join(f"{name}: {error!r}" for name, error in errors)
+        )
+    return results
+
+
+def keyvalue_pairs(row):
+    """
+    {(key_name, value_name), ...} targeted by a lineitem row
+    """
+    pairs = set()
+    for column in TARGETING_KEYVALUE_COLUMNS:
+        if row.get(column, "") != "":
+            key_name, value_name, _ = parse_keyvalue(row[column])
+            pairs.add((key_name, value_name))
+    return pairs
+
+
+def parse_keyvalue(keyvalue):
+    """
+    "hoge=fuga" / "hoge!=fuga" を (key_name, value_name, operator) に分解する
+    """
+    if "!=" in keyvalue:
+        key_name, value_name = keyvalue.split("!=", 1)
+        return key_name, value_name, "IS_NOT"
+    elif "=" in keyvalue:
+        key_name, value_name = keyvalue.split("=", 1)
+        return key_name, value_name, "IS"
+    else:
+        raise GaspException(f"Unsupported format: {keyvalue}")
+
+
+class TokenBucket:
+    """
+    allows `rate` calls per second with bursts up to `burst` calls, shared between threads
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if 0 < wait:
+            sleep(wait)
+
+
+def lineitem_updates(settings, existing):
+    """
+    returns [(lineitem, diffs), ...] of existing lineitems overwritten only at the fields (diffs)
+    which differ from settings of the same name
+    fields set on the server (e.g. status, stats) are sent back as they are
+    """
+    existing_by_name = index_by("name", existing)
+    updates = []
+    for setting in settings:
+        lineitem = existing_by_name[setting["name"]]
+        diffs = differences(setting, normalize(lineitem), LINEITEM_IGNORED_FIELDS)
+        if len(diffs) == 0:
+            # unchanged lineitems are never sent
+            continue
+        logger.info(f'lineitem {setting["name"]}: updating {", ".join(diffs)}')
+        updates.append((apply_differences(lineitem, setting, diffs), diffs))
+    return updates
+
+
+def lineitem_key(lineitem):
+    # lineitem names are unique in each order
+    return (lineitem["orderId"], lineitem["name"])
 
 
-def is_containing(setting, existing):
-    se = setting.copy()
-    se.pop("xsi_type", None)  # not containing serialized object
-    native_object = zeep.helpers.serialize_object(existing)
-    return se.items() <= native_object.items()
+def is_retryable(fault, method_name=""):
+    """
+    a server error on a write may come after the write has been applied,
+    so writes which are not idempotent (e.g. createCreatives) are retried only when nothing has been applied
+    """
+    errors = RETRYABLE_ERRORS
+    if method_name.startswith(WRITE_METHOD_PREFIXES) and not method_name.startswith(IDEMPOTENT_WRITE_PREFIXES):
+        errors = REJECTED_WRITE_ERRORS
+    return any(e in str(fault) for e in errors)
+
+
+def failed_items(fault, field):
+    """
+    returns {index: errorString} of items in the request which are pointed by the fault
+    e.g. fieldPath "lineItemCreativeAssociations[3].creativeId" -> {3: "..."}
+    """
+    items = {}
+    for error in getattr(fault, "errors", None) or []:
+        m = re.match(rf"{field}\[(\d+)\]", getattr(error, "fieldPath", None) or "")
+        if m:
+            items[int(m.group(1))] = getattr(error, "errorString", None) or str(error)
+    return items
+
+
+class RequestScheduler:
+    """
+    every SOAP call goes through here
+    write calls are throttled by a token bucket, retryable faults are retried with exponential backoff and jitter
+    """
+
+    def __init__(self, requests_per_second, burst, max_retries, backoff_base, recorder):
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.recorder = recorder
+
+    def call(self, service_name, name, method, *args):
+        is_write = name.startswith(WRITE_METHOD_PREFIXES)
+        start = monotonic()
+        for attempt in range(self.max_retries + 1):
+            if is_write:
+                self.bucket.acquire()
+            try:
+                response = method(*args)
+                items = count_items(args[0] if is_write else response)
+                self.recorder.record(service_name, name, items, monotonic() - start, attempt, len(repr(args)))
+                return response
+            except GoogleAdsServerFault as e:
+                if self.max_retries <= attempt or not is_retryable(e, name):
+                    self.recorder.record(service_name, name, 0, monotonic() - start, attempt, len(repr(args)))
+                    raise
+                self.backoff(name, attempt, e)
+
+    def backoff(self, name, attempt, fault):
+        delay = random.uniform(0, self.backoff_base * 2 ** attempt)
+        logger.warning(f"{name}: retrying in {delay:.1f}s ({attempt+1}/{self.max_retries}): {fault}")
+        sleep(delay)
+
+
+class ScheduledService:
+    """
+    service proxy whose method calls go through the RequestScheduler
+    """
+
+    def __init__(self, service, scheduler, service_name):
+        self.service = service
+        self.scheduler = scheduler
+        self.service_name = service_name
+
+    def __getattr__(self, name):
+        return functools.partial(self.scheduler.call, self.service_name, name, getattr(self.service, name))
+
+
+class ServiceRegistry:
+    """
+    builds each service once per thread and keeps it, SOAP clients are not shared between threads
+    services in a thread share one keep-alive HTTP session instead of a session per service
+    """
+
+    def __init__(self, client, scheduler):
+        self.client = client
+        self.scheduler = scheduler
+        self.local = threading.local()
+
+    def get(self, service_name):
+        if not hasattr(self.local, "services"):
+            self.local.services, self.local.session = {}, None
+        if service_name not in self.local.services:
+            service = self.client.GetService(service_name, version=API_VERSION)
+            self.share_session(service)
+            self.local.services[service_name] = ScheduledService(service, self.scheduler, service_name)
+        return self.local.services[service_name]
+
+    def share_session(self, service):
+        # zeep based services (googleads.common.ZeepServiceProxy) own a transport with a requests session
+        transport = getattr(getattr(service, "zeep_client", None), "transport", None)
+        if transport is None:
+            return
+        if self.local.session is None:
+            self.local.session = transport.session
+        else:
+            transport.session.close()
+            transport.session = self.local.session
 
 
 class AdManager:
@@ -69,14 +331,89 @@ class AdManager:
         }
         return yaml.dump(setting)
 
-    def __init__(self, config):
-        admanager_setting = self.setting_yaml_string(config)
+    def __init__(self, config, refresh_cache=False, client=None, recorder=None, journal=None):
+        """
+        client: an object which has GetService(service_name, version) like AdManagerClient (e.g. gasp.fake)
+        recorder: gasp.instrument.Recorder which records every SOAP call
+        journal: gasp.journal.Journal which checkpoints every successful batch of setup_*
+        """
+        self.recorder = recorder if recorder is not None else Recorder()
+        self.journal = journal
         self.currency_code = config.get("ad_manager.currency_code")
-        self.client = ad_manager.AdManagerClient.LoadFromString(admanager_setting)
+        self.lineitem_batch_size = config.get_or_default("ad_manager.batch_size.lineitem")
+        self.creative_batch_size = config.get_or_default("ad_manager.batch_size.creative")
+        self.lica_batch_size = config.get_or_default("ad_manager.batch_size.lineitemcreativeassociation")
+        if client is None:
+            client = ad_manager.AdManagerClient.LoadFromString(self.setting_yaml_string(config))
+            # WSDL of a fixed API_VERSION never changes, keep it on disk across runs
+            client.cache = zeep.cache.SqliteCache(
+                path=config.get_or_default("ad_manager.wsdl_cache.path"),
+                timeout=config.get_or_default("ad_manager.wsdl_cache.ttl"),
+            )
+        self.client = client
+        self.key_values = {}
+        self.lookups = LRUCache(config.get_or_default("ad_manager.lookup_cache_size"))
+        self.scheduler = RequestScheduler(
+            requests_per_second=config.get_or_default("ad_manager.rate_limit.requests_per_second"),
+            burst=config.get_or_default("ad_manager.rate_limit.burst"),
+            max_retries=config.get_or_default("ad_manager.retry.max_retries"),
+            backoff_base=config.get_or_default("ad_manager.retry.backoff_base"),
+            recorder=self.recorder,
+        )
+        self.services = ServiceRegistry(self.client, self.scheduler)
+
+        self.cache = None
+        if config.get_or_default("cache.path") is not None:
+            self.cache = PersistentCache(
+                config.get_or_default("cache.path"),
+                ttl=config.get_or_default("cache.ttl"),
+                namespace=str(config.get("ad_manager.network_code")),
+            )
+            if refresh_cache:
+                self.cache.clear()
+
+    def service(self, service_name):
+        """
+        returns a service proxy whose calls are scheduled by the RequestScheduler
+        """
+        return self.services.get(service_name)
 
-    @memoize
     def find_one(self, service_name, method, *args):
-        service = self.client.GetService(service_name, version=API_VERSION)
+        """
+        find an object by key value pairs, results (including not found) are cached in the instance
+        """
+        key = (service_name, method, *args)
+        result = self.lookups.get(key)
+        if result is None:
+            try:
+                result = self.__find_one(service_name, method, *args)
+            except ObjectNotFound as e:
+                result = e
+            self.lookups.set(key, result)
+        if isinstance(result, ObjectNotFound):
+            raise ObjectNotFound(str(result))
+        return result
+
+    def prime_lookup(self, value, service_name, method, *args):
+        """
+        put an object fetched in bulk into the lookup cache of find_one
+        """
+        self.lookups.set((service_name, method, *args), value)
+
+    def report_cache_stats(self):
+        stats = self.lookups.stats()
+        logger.info(
+            f"lookup cache: hits {stats['hits']}, misses {stats['misses']}, "
+            f"evictions {stats['evictions']}, size {stats['size']}"
+        )
+
+    def __find_one(self, service_name, method, *args):
+        if self.cache is not None:
+            cached = self.cache.get(service_name, method, *args)
+            if cached is not None:
+                return cached
+
+        service = self.service(service_name)
         query = ad_manager.StatementBuilder()
         if len(args) % 2 != 0:
             raise Exception("args must be key value pair")
@@ -87,17 +424,38 @@ class AdManager:
         response = getattr(service, method)(query.ToStatement())
         assert "results" in response
         if len(response["results"]) == 1:
+            if self.cache is not None:
+                self.cache.set(service_name, method, *args, value=zeep.helpers.serialize_object(response["results"][0]))
             return response["results"][0]
         else:
-            raise ObjectNotFound(f"object not found: f{pformat(*args)}")
+            raise ObjectNotFound(f"object not found: {method} {pformat(args)}")
 
-    def find_multi(self, service_name, method, key, values):
-        service = self.client.GetService(service_name, version=API_VERSION)
-        query = ad_manager.StatementBuilder(limit=None, offset=None)
-        query.Where(f"{key} IN (:values)").WithBindVariable("values", values)
-        response = getattr(service, method)(query.ToStatement())
-        assert "results" in response
-        return response["results"]
+    def find_iter(self, service_name, method, where, **binds):
+        """
+        yield all objects matching the where clause, paging by limit/offset until totalResultSetSize
+        """
+        service = self.service(service_name)
+        query = ad_manager.StatementBuilder(limit=PAGE_SIZE)
+        query.Where(where)
+        [query.WithBindVariable(k, v) for k, v in binds.items()]
+
+        while True:
+            response = getattr(service, method)(query.ToStatement())
+            assert "results" in response
+            yield from response["results"]
+            query.offset += query.limit
+            if len(response["results"]) == 0 or response["totalResultSetSize"] <= query.offset:
+                break
+
+    def find_multi(self, service_name, method, key, values, where=None, **binds):
+        """
+        yield objects whose key is in values
+        values are split into bounded IN clauses, additional conditions can be given by where and binds
+        """
+        values = values if isinstance(values, (list, tuple, set)) else [values]
+        for chunk in chunked(values, IN_CLAUSE_SIZE):
+            clause = f"{key} IN (:values)" if where is None else f"{where} AND {key} IN (:values)"
+            yield from self.find_iter(service_name, method, clause, values=chunk, **binds)
 
     def handle_compare_result(self, object_name, settings, result):
         if len(result["different"]) != 0:
@@ -118,6 +476,13 @@ class AdManager:
         return self.find_one("CustomTargetingService", "getCustomTargetingKeysByStatement", "name", key_name)
 
     def find_key_value(self, key_name, value_name):
+        if (key_name, value_name) in self.key_values:
+            return self.key_values[(key_name, value_name)]
+        if self.cache is not None:
+            cached = self.cache.get("key_value", key_name, value_name)
+            if cached is not None:
+                return tuple(cached)
+
         key = self.find_key(key_name)
         value = self.find_one(
             "CustomTargetingService",
@@ -129,15 +494,87 @@ class AdManager:
         )
         return key, value
 
-    def search_lineitems(self, order_id, names):
-        service = self.client.GetService("LineItemService", version=API_VERSION)
-        query = ad_manager.StatementBuilder()
-        query.Where("orderId = :order_id AND name IN (:names)").WithBindVariable("order_id", order_id).WithBindVariable(
-            "names", names
-        )
-        response = service.getLineItemsByStatement(query.ToStatement())
-        assert "results" in response
-        return response["results"]
+    def find_creatives_of(self, settings):
+        """
+        existing creatives with the names of settings
+        """
+        names = list(map(lambda s: s["name"], settings))
+        return self.find_multi("CreativeService", "getCreativesByStatement", "name", names)
+
+    def find_lineitems_of(self, settings):
+        """
+        existing lineitems with the names of settings in their orders
+        """
+        for order_id, order_settings in group_by("orderId", settings).items():
+            names = list({s["name"] for s in order_settings})
+            yield from self.find_multi(
+                "LineItemService",
+                "getLineItemsByStatement",
+                "name",
+                names,
+                where="orderId = :order_id",
+                order_id=order_id,
+            )
+
+    def prefetch_key_values(self, lineitem_rows):
+        """
+        resolve every key=value in lineitem rows at once and index them for keyvalue_to_criteria
+        raises ObjectNotFound listing all missing keys and values
+        """
+        missing = self.resolve_key_values(lineitem_rows)
+        if 0 < len(missing):
+            raise ObjectNotFound("custom targeting not found:\n" + "\n".join(missing))
+
+    def resolve_key_values(self, lineitem_rows):
+        """
+        same as prefetch_key_values but returns missing keys and values instead of raising
+        """
+        pairs = set()
+        for row in lineitem_rows:
+            pairs |= keyvalue_pairs(row)
+        if self.cache is not None:
+            for key_name, value_name in list(pairs):
+                cached = self.cache.get("key_value", key_name, value_name)
+                if cached is not None:
+                    self.key_values[(key_name, value_name)] = tuple(cached)
+                    pairs.remove((key_name, value_name))
+        if len(pairs) == 0:
+            return []
+
+        key_names = sorted({k for k, _ in pairs})
+        logger.info(f"custom targeting: prefetching {len(key_names)} keys, {len(pairs)} values")
+        keys = list(self.find_multi("CustomTargetingService", "getCustomTargetingKeysByStatement", "name", key_names))
+        key_by_name = {k["name"]: k for k in keys}
+        key_by_id = {k["id"]: k for k in keys}
+
+        # key ids are bound into an IN clause as well, so they are chunked too
+        values = []
+        for key_chunk in chunked(sorted(key_by_id.keys()), IN_CLAUSE_SIZE):
+            chunk_names = {key_by_id[i]["name"] for i in key_chunk}
+            value_names = sorted({v for k, v in pairs if k in chunk_names})
+            values += self.find_multi(
+                "CustomTargetingService",
+                "getCustomTargetingValuesByStatement",
+                "name",
+                value_names,
+                where="customTargetingKeyId IN (:key_ids)",
+                key_ids=key_chunk,
+            )
+        value_by_pair = {(key_by_id[v["customTargetingKeyId"]]["name"], v["name"]): v for v in values}
+
+        missing = []
+        for key_name, value_name in sorted(pairs):
+            if key_name not in key_by_name:
+                missing.append(f"key: {key_name}")
+            elif (key_name, value_name) not in value_by_pair:
+                missing.append(f"value: {key_name}={value_name}")
+            else:
+                key_value = (key_by_name[key_name], value_by_pair[(key_name, value_name)])
+                self.key_values[(key_name, value_name)] = key_value
+                if self.cache is not None:
+                    native = zeep.helpers.serialize_object(list(key_value))
+                    self.cache.set("key_value", key_name, value_name, value=native)
+        return sorted(set(missing))
 
     def setup_orders(self, order_rows):
         settings = []
@@ -150,118 +587,363 @@ class AdManager:
         existing = self.find_multi("OrderService", "getOrdersByStatement", "name", names)
         result = compare_objects("name", settings, existing)
         self.handle_compare_result("orders", settings, result)
-        service = self.client.GetService("OrderService", version=API_VERSION)
+        service = self.service("OrderService")
         if 0 < len(result["notfound"]):
             service.createOrders(result["notfound"])
 
     def setup_creatives(self, creative_rows=[], order_rows=[], lineitem_rows=[]):
         order_to_advertiser = {o["name"]: o["advertiser_name"] for o in order_rows}
-        lineitem_to_sizes = {li["name"]: li["sizes"] for li in lineitem_rows}
-
-        blocks = list(chunked(creative_rows, 30))
-        for i, rows in enumerate(blocks):
-            logger.info(f"creatives: checking ({i+1}/{len(blocks)})")
-            settings = []
-            for row in rows:
-                advertiser = self.find_advertiser(order_to_advertiser[row["order_name"]])
-                lineitem_size = lineitem_to_sizes[row["lineitem_name"]]
-                size = dict(zip(["width", "height"], map(int, lineitem_size.split("x"))))
-                settings.append(
-                    {
-                        "xsi_type": "ThirdPartyCreative",
-                        "name": row["name"],
-                        "advertiserId": advertiser["id"],
-                        "size": {**size, "isAspectRatio": False},
-                        "snippet": row["snippet"],
-                        "isSafeFrameCompatible": True,  # TODO configurable
-                    }
-                )
+        result = self.provision_creatives(creative_rows, order_to_advertiser, lineitem_sizes(lineitem_rows))
+        logger.info(f'creatives: created {len(result["created"])}/{len(creative_rows)}')
 
-            names = list(map(lambda o: o["name"], settings))
-            existing = self.find_multi("CreativeService", "getCreativesByStatement", "name", names)
-            result = compare_objects("name", settings, existing)
-            self.handle_compare_result("creatives", settings, result)
-            if 0 < len(result["notfound"]):
-                service = self.client.GetService("CreativeService", version=API_VERSION)
-                service.createCreatives(result["notfound"])
-            sleep(1)
+    def setup_lineitems(self, order_rows=[], lineitem_rows=[], workers=1, update=False):
+        """
+        with workers > 1, orders are provisioned concurrently, errors are reported after all orders finished
+        with update, existing lineitems different from the sheet are updated instead of raising ExistingDifferentObject
+        """
+        self.prefetch_key_values(lineitem_rows)
+        lineitem_rows_by_order = group_by("order_name", lineitem_rows)
 
-    def setup_lineitems(self, order_rows=[], lineitem_rows=[]):
         # Process for each order because uniqueness is in (order.name, lineitem.name) pairs
-        for order_row in order_rows:
+        def setup_order(order_row):
             order = self.find_order(order_row["name"])
-            lineitem_rows_in_order = list(filter(lambda r: r["order_name"] == order_row["name"], lineitem_rows))
-            self.__setup_lineitem_in_order(order, lineitem_rows_in_order)
+            result = self.provision_lineitems(order, lineitem_rows_by_order.get(order_row["name"], []), update)
+            logger.info(
+                f'lineitems in order {order["name"]}: created {len(result["created"])}, '
+                f'updated {result["updated"]}, existing {result["existing"]}'
+            )
+
+        run_per_order(order_rows, setup_order, workers)
 
     def setup_lineitemassociation(self, order_rows=[], lineitem_rows=[], creative_rows=[]):
-        for order_row in order_rows:
-            logger.info(f'lineitem creative associations in order {order_row["name"]}')
-            order = self.find_order(order_row["name"])
-            lineitems = self.find_multi("LineItemService", "getLineItemsByStatement", "orderId", order["id"])
+        """
+        returns ids resolved on the way
+        {orders: {name: id}, lineitems: {order_name: {name: id}}, creatives: {name: id}}
+        ids and LICAs recorded in the journal are not queried again
+        """
+        ids = {"orders": {}, "lineitems": {}}
+        lineitem_to_sizes = lineitem_sizes(lineitem_rows)
+        lineitem_rows_by_order = group_by("order_name", lineitem_rows)
+        creative_rows_by_order = group_by("order_name", creative_rows)
+        creative_ids = self.__creative_ids(list(map(lambda r: r["name"], creative_rows)))
 
-            creative_rows_in_order = list(filter(lambda r: r["order_name"] == order_row["name"], creative_rows))
-            creatives = self.find_multi(
-                "CreativeService",
-                "getCreativesByStatement",
-                "name",
-                list(map(lambda r: r["name"], creative_rows_in_order)),
+        def setup_order(order_row):
+            order = self.find_order(order_row["name"])
+            lineitem_names = list(map(lambda r: r["name"], lineitem_rows_by_order.get(order["name"], [])))
+            lineitem_ids = self.__lineitem_ids(order, lineitem_names)
+            ids["orders"][order["name"]] = order["id"]
+            ids["lineitems"][order["name"]] = lineitem_ids
+
+            rows = creative_rows_by_order.get(order["name"], [])
+            counts = self.provision_associations(
+                association_settings(rows, lineitem_ids, creative_ids, lineitem_to_sizes)
             )
-
-            settings = []
-            for row in creative_rows_in_order:
-                lineitem = next(filter(lambda l: l["name"] == row["lineitem_name"], lineitems))
-                creative = next(filter(lambda c: c["name"] == row["name"], creatives))
-                settings.append({"lineItemId": lineitem["id"], "creativeId": creative["id"]})
-
-            existing = self.find_multi(
-                "LineItemCreativeAssociationService",
-                "getLineItemCreativeAssociationsByStatement",
-                "lineItemId",
-                list(map(lambda l: l["id"], lineitems)),
+            logger.info(
+                f'lineitem creative associations in order {order["name"]}: '
+                f'created {counts["created"]}, existing {counts["existing"]}'
             )
 
-            to_creates = list(
-                filter(
-                    lambda s: not any(
-                        (e["lineItemId"] == s["lineItemId"] and e["creativeId"] == s["creativeId"] for e in existing)
-                    ),
-                    settings,
+        run_per_order(order_rows, setup_order)
+        ids["creatives"] = creative_ids
+        return ids
+
+    def provision_lineitems(self, order, lineitem_rows, update=False):
+        """
+        compare lineitem rows of an order with its lineitems, create missing ones and update changed ones with update
+        lineitems recorded in the journal (or unchanged since the last run) need neither compare nor lookup
+        returns {ids: {name: id}, created: {name, ...}, updated: int, existing: int}
+        """
+        ids = {}
+        if self.journal is not None:
+            for row in lineitem_rows:
+                ids.update(self.journal.lineitem_ids(order["name"], [row["name"]]) or {})
+        pending = [r for r in lineitem_rows if r["name"] not in ids]
+        result = {"ids": ids, "created": set(), "updated": 0, "existing": len(ids)}
+        if len(pending) == 0:
+            return result
+
+        logger.info(f'lineitems: checking {len(pending)} in order {order["name"]}')
+        settings = list(map(self.generate_lineitem_config, pending))
+        existing = list(self.find_lineitems_of(settings))
+        compared = compare_objects("name", settings, existing, ignore=LINEITEM_IGNORED_FIELDS)
+        updates = []
+        if update:
+            updates = lineitem_updates(compared["different"], existing)
+            compared["different"] = []
+        self.handle_compare_result("lineitem", settings, compared)
+        result["existing"] += len(compared["existing"])
+
+        ids.update({li["name"]: li["id"] for li in existing})
+        if self.journal is not None:
+            # lineitems to update are recorded after they are sent
+            unchanged = {s["name"]: ids[s["name"]] for s in compared["existing"]}
+            self.journal.record_lineitems(order["name"], unchanged)
+
+        created = self.create_lineitems(compared["notfound"], {order["id"]: order["name"]})
+        ids.update({li["name"]: li["id"] for li in created})
+        result["created"] = {li["name"] for li in created}
+
+        if 0 < len(updates):
+            result["updated"] = self.update_lineitems(updates)
+            if self.journal is not None:
+                self.journal.record_lineitems(order["name"], {li["name"]: li["id"] for li, _ in updates})
+        return result
+
+    def provision_creatives(self, creative_rows, order_to_advertiser, lineitem_to_sizes):
+        """
+        compare creative rows with existing creatives in batches of `ad_manager.batch_size.creative`
+        and create missing ones, creatives recorded in the journal are not queried again
+        returns {ids: {name: id}, created: {name, ...}}
+        """
+        ids = {}
+        if self.journal is not None:
+            recorded = self.journal.creatives
+            ids = {r["name"]: recorded[r["name"]] for r in creative_rows if r["name"] in recorded}
+        pending = [r for r in creative_rows if r["name"] not in ids]
+        result = {"ids": ids, "created": set()}
+
+        blocks = list(chunked(pending, self.creative_batch_size))
+        for i, rows in enumerate(blocks):
+            logger.info(f"creatives: checking ({i+1}/{len(blocks)})")
+            settings = self.creative_settings(rows, order_to_advertiser, lineitem_to_sizes)
+            existing = list(self.find_creatives_of(settings))
+            compared = compare_objects("name", settings, existing)
+            self.handle_compare_result("creatives", settings, compared)
+            if self.journal is not None:
+                self.journal.record_creatives({c["name"]: c["id"] for c in existing})
+
+            created = self.create_creatives(compared["notfound"])
+            ids.update({c["name"]: c["id"] for c in existing + created})
+            result["created"].update(c["name"] for c in created)
+        return result
+
+    def provision_associations(self, settings, new_lineitem_ids=(), lookup=True):
+        """
+        create LICAs of settings which are neither recorded in the journal nor existing
+        lineitems in new_lineitem_ids were created just now and have no LICA, so they are not looked up
+        without lookup, settings are known to be missing (e.g. compared by Planner)
+        returns counts of create_associations, raises ProvisioningFailed when some of them failed
+        """
+        recorded = self.journal.associations if self.journal is not None else set()
+        pending = list(filter(lambda s: (s["lineItemId"], s["creativeId"]) not in recorded, settings))
+        existing = set()
+        lookup_ids = {s["lineItemId"] for s in pending} - set(new_lineitem_ids)
+        if lookup and 0 < len(lookup_ids):
+            existing = association_pairs(
+                self.find_multi(
+                    "LineItemCreativeAssociationService",
+                    "getLineItemCreativeAssociationsByStatement",
+                    "lineItemId",
+                    list(lookup_ids),
                 )
             )
+        to_creates = list(filter(lambda s: (s["lineItemId"], s["creativeId"]) not in existing, pending))
 
-            service = self.client.GetService("LineItemCreativeAssociationService", version=API_VERSION)
-            blocks = chunked(to_creates, 20)
-            for i, block in enumerate(blocks):
-                service.createLineItemCreativeAssociations(to_creates)
+        counts = self.create_associations(to_creates)
+        counts["existing"] += len(settings) - len(to_creates)
+        if 0 < len(counts["failed"]):
+            raise ProvisioningFailed(f"failed to create lineitem creative associations:\n{pformat(counts['failed'])}")
+        return counts
 
-    def __setup_lineitem_in_order(self, order, lineitem_rows):
-        logger.info(f'lineitem settings in order {order["name"]}')
+    def create_lineitems(self, settings, order_names):
+        """
+        create lineitems in batches of `ad_manager.batch_size.lineitem` and returns them
+        order_names: {order id: name} to record created lineitems in the journal
+        """
+        created = []
+        blocks = list(chunked(settings, self.lineitem_batch_size))
+        for i, block in enumerate(blocks):
+            logger.info(f"lineitems: creating ({i+1}/{len(blocks)})")
+            lineitems = self.create_objects(
+                "LineItemService", "createLineItems", block, self.find_lineitems_of, lineitem_key
+            )
+            if self.journal is not None:
+                for order_id, by_order in group_by("orderId", lineitems).items():
+                    self.journal.record_lineitems(order_names[order_id], {li["name"]: li["id"] for li in by_order})
+            created += lineitems
+        return created
+
+    def create_creatives(self, settings):
+        """
+        create creatives in batches of `ad_manager.batch_size.creative` and returns them
+        """
+        created = []
+        blocks = list(chunked(settings, self.creative_batch_size))
+        for i, block in enumerate(blocks):
+            logger.info(f"creatives: creating ({i+1}/{len(blocks)})")
+            creatives = self.create_objects("CreativeService", "createCreatives", block, self.find_creatives_of)
+            if self.journal is not None:
+                self.journal.record_creatives({c["name"]: c["id"] for c in creatives})
+            created += creatives
+        return created
+
+    def creative_settings(self, creative_rows, order_to_advertiser, lineitem_to_sizes):
+        """
+        order_to_advertiser: {order name: advertiser name}
+        lineitem_to_sizes: {(order_name, lineitem name): sizes} of lineitem_sizes
+        """
         settings = []
-        for row in lineitem_rows:
-            config = self.generate_lineitem_config(row)
-            settings.append(config)
+        for row in creative_rows:
+            advertiser_name = order_to_advertiser[row["order_name"]]
+            sizes = lineitem_to_sizes[(row["order_name"], row["lineitem_name"])]
+            settings.append(self.generate_creative_config(row, advertiser_name, sizes))
+        return settings
 
-        blocks = list(chunked(settings, 20))
+    def __lineitem_ids(self, order, names):
+        """
+        returns {name: id} of lineitems in the order, from the journal when all names are recorded
+        """
+        if self.journal is not None:
+            recorded = self.journal.lineitem_ids(order["name"], names)
+            if recorded is not None:
+                return recorded
+        lineitems = self.find_multi("LineItemService", "getLineItemsByStatement", "orderId", order["id"])
+        return {li["name"]: li["id"] for li in lineitems}
+
+    def __creative_ids(self, names):
+        """
+        returns {name: id} of creatives, only names not recorded in the journal are queried
+        """
+        recorded = {}
+        if self.journal is not None:
+            recorded = {name: self.journal.creatives[name] for name in names if name in self.journal.creatives}
+        missing = [name for name in names if name not in recorded]
+        creatives = self.find_multi("CreativeService", "getCreativesByStatement", "name", missing)
+        return {**recorded, **{c["name"]: c["id"] for c in creatives}}
+
+    def create_objects(self, service_name, method, settings, find, key=lambda o: o["name"]):
+        """
+        create objects and returns them
+        a server error may come after the objects have been created, then they are looked up by find(pending)
+        and only objects still missing (by key) are sent again, so a retry never creates duplicates
+        """
+        service = self.service(service_name)
+        created = []
+        pending = settings
+        for attempt in range(self.scheduler.max_retries + 1):
+            try:
+                return created + list(getattr(service, method)(pending))
+            except GoogleAdsServerFault as e:
+                # faults retryable for the method were already retried by the scheduler,
+                # only server errors which may have been applied are handled here
+                ambiguous = is_retryable(e) and not is_retryable(e, method)
+                if self.scheduler.max_retries <= attempt or not ambiguous:
+                    raise
+                self.scheduler.backoff(method, attempt, e)
+                existing = {key(o): o for o in find(pending)}
+                created += [existing[key(s)] for s in pending if key(s) in existing]
+                pending = [s for s in pending if key(s) not in existing]
+                if len(pending) == 0:
+                    return created
+
+    def create_associations(self, settings):
+        """
+        create LICAs in batches of `ad_manager.batch_size.lineitemcreativeassociation`
+        returns {created: int, existing: int, failed: [(setting, error), ...]}
+        """
+        counts = {"created": 0, "existing": 0, "failed": []}
+        blocks = list(chunked(settings, self.lica_batch_size))
+        for i, block in enumerate(blocks):
+            result = self.__create_association_batch(block)
+            if self.journal is not None:
+                pairs = {(s["lineItemId"], s["creativeId"]) for s in block}
+                failed = {(s["lineItemId"], s["creativeId"]) for s, _ in result["failed"]}
+                self.journal.record_associations(list(pairs - failed))
+            logger.info(
+                f"lineitem creative associations: batch ({i+1}/{len(blocks)}) "
+                f'created {result["created"]}, existing {result["existing"]}, failed {len(result["failed"])}'
+            )
+            counts["created"] += result["created"]
+            counts["existing"] += result["existing"]
+            counts["failed"].extend(result["failed"])
+        return counts
+
+    def __create_association_batch(self, block):
+        # A create call is rejected as a whole when any item is invalid,
+        # so drop the items pointed by the fault and send the rest again.
+        service = self.service("LineItemCreativeAssociationService")
+        result = {"created": 0, "existing": 0, "failed": []}
+        pending = block
+        while 0 < len(pending):
+            try:
+                created = service.createLineItemCreativeAssociations(pending)
+                result["created"] += len(created)
+                break
+            except GoogleAdsServerFault as e:
+                items = failed_items(e, "lineItemCreativeAssociations")
+                if len(items) == 0:
+                    result["failed"].extend((s, str(e)) for s in pending)
+                    break
+                for idx, error in items.items():
+                    if any(d in error for d in DUPLICATE_ERRORS):
+                        result["existing"] += 1
+                    else:
+                        result["failed"].append((pending[idx], error))
+                pending = [s for idx, s in enumerate(pending) if idx not in items]
+        return result
+
+    def update_lineitems(self, updates):
+        """
+        send updated lineitems of lineitem_updates in batches of `ad_manager.batch_size.lineitem`
+        LICAs of lineitems whose sizes changed get the size override of the new sizes
+        """
+        lineitems = [lineitem for lineitem, _ in updates]
+        service = self.service("LineItemService")
+        blocks = list(chunked(lineitems, self.lineitem_batch_size))
         for i, block in enumerate(blocks):
-            logger.info(f"lineitems: checking ({i+1}/{len(blocks)})")
+            logger.info(f"lineitems: updating ({i+1}/{len(blocks)})")
+            service.updateLineItems(block)
+
+        resized = [lineitem for lineitem, diffs in updates if any(d.startswith("creativePlaceholders") for d in diffs)]
+        if 0 < len(resized):
+            self.update_association_sizes(resized)
+        return len(lineitems)
 
-            names = list(map(lambda l: l["name"], settings))
-            existing = self.search_lineitems(order["id"], names)
-            result = compare_objects("name", settings, existing, key_only=True)
-            self.handle_compare_result("lineitem", settings, result)
-            if 0 < len(result["notfound"]):
-                service = self.client.GetService("LineItemService", version=API_VERSION)
-                service.createLineItems(result["notfound"])
-            sleep(1)
+    def update_association_sizes(self, lineitems):
+        """
+        set the size override of existing LICAs to the sizes of lineitems, only LICAs which differ are sent
+        LICAs not created yet get the override when they are created
+        """
+        sizes_by_id = {}
+        for lineitem in lineitems:
+            sizes = [placeholder["size"] for placeholder in lineitem["creativePlaceholders"]]
+            # a single size is the size of the creative itself, no override (see association_config)
+            sizes_by_id[lineitem["id"]] = sizes if 1 < len(sizes) else None
+
+        to_updates = []
+        associations = self.find_multi(
+            "LineItemCreativeAssociationService",
+            "getLineItemCreativeAssociationsByStatement",
+            "lineItemId",
+            list(sizes_by_id.keys()),
+        )
+        for association in associations:
+            sizes = sizes_by_id[association["lineItemId"]]
+            current = normalize(association).get("sizes") or None
+            if sizes is None and current is None:
+                continue
+            if sizes is not None and current is not None and len(differences(sizes, current)) == 0:
+                continue
+            association["sizes"] = sizes
+            to_updates.append(association)
+
+        service = self.service("LineItemCreativeAssociationService")
+        blocks = list(chunked(to_updates, self.lica_batch_size))
+        for i, block in enumerate(blocks):
+            logger.info(f"lineitem creative associations: updating sizes ({i+1}/{len(blocks)})")
+            service.updateLineItemCreativeAssociations(block)
+        return len(to_updates)
 
     def generate_lineitem_config(self, row):
         order = self.find_order(row["order_name"])
-        size = dict(zip(["width", "height"], map(int, row["sizes"].split("x"))))
+        placeholders = [{"size": size_config(size)} for size in parse_sizes(row["sizes"])]
 
-        columns = list(map(lambda n: "targetingKeyValue" + str(n), range(1, 12 + 1)))
-        criterias = list(map(lambda c: self.keyvalue_to_criteria(row[c]), filter(lambda c: row[c] != "", columns)))
+        columns = filter(lambda c: row.get(c, "") != "", TARGETING_KEYVALUE_COLUMNS)
+        criterias = list(map(lambda c: self.keyvalue_to_criteria(row[c]), columns))
         ad_units = list(map(lambda id: {"adUnitId": id}, row["targetingUnit"].split(",")))
-        custom_targeting = {"xsi_type": "CustomCriteriaSet", "logicalOperator": "OR", "children": criterias}
+        custom_targeting = canonical_custom_targeting(
+            {"xsi_type": "CustomCriteriaSet", "logicalOperator": "OR", "children": criterias}
+        )
 
         return {
             "orderId": order["id"],
@@ -272,7 +954,7 @@ class AdManager:
             "lineItemType": "PRICE_PRIORITY",  # 価格優先
             "costPerUnit": {"currencyCode": self.currency_code, "microAmount": int(row["costPerUnit"] * 1_000_000)},
             "costType": "CPM",
-            "creativePlaceholders": [{"size": size}],
+            "creativePlaceholders": placeholders,
             "primaryGoal": {"goalType": "NONE"},
             "targeting": {
                 "inventoryTargeting": {"targetedAdUnits": ad_units},
@@ -280,18 +962,24 @@ class AdManager:
             },
         }
 
+    def generate_creative_config(self, row, advertiser_name, lineitem_sizes):
+        advertiser = self.find_advertiser(advertiser_name)
+        return {
+            "xsi_type": "ThirdPartyCreative",
+            "name": row["name"],
+            "advertiserId": advertiser["id"],
+            "size": size_config(parse_sizes(lineitem_sizes)[0]),
+            "snippet": row["snippet"],
+            "isSafeFrameCompatible": True,  # TODO configurable
+        }
+
     def keyvalue_to_criteria(self, keyvalue):
         """
         "hoge=fuga" のような入力からターゲティング設定に利用する criteai dict を返す
         """
-        if "!=" in keyvalue:
-            key, value = self.find_key_value(*keyvalue.split("!="))
-            return {"xsi_type": "CustomCriteria", "keyId": key["id"], "valueIds": [value["id"]], "operator": "IS_NOT"}
-        elif "=" in keyvalue:
-            key, value = self.find_key_value(*keyvalue.split("="))
-            return {"xsi_type": "CustomCriteria", "keyId": key["id"], "valueIds": [value["id"]], "operator": "IS"}
-        else:
-            raise f"Unsupported format: {keyvalue}"
+        key_name, value_name, operator = parse_keyvalue(keyvalue)
+        key, value = self.find_key_value(key_name, value_name)
+        return {"xsi_type": "CustomCriteria", "keyId": key["id"], "valueIds": [value["id"]], "operator": operator}
 
 
 class GaspException(Exception):
@@ -304,3 +992,7 @@ class ObjectNotFound(GaspException):
 
 class ExistingDifferentObject(GaspException):
     "There are object which has differences with creatings."
+
+
+class ProvisioningFailed(GaspException):
+    "Some of concurrent provisionings failed."
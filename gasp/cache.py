@@ -0,0 +1,84 @@
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class PersistentCache:
+    """
+    SQLite backed key-value store which survives across runs
+    entries are scoped by namespace (network code) and expire after ttl seconds
+    """
+
+    def __init__(self, path, ttl, namespace):
+        self.ttl = ttl
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache"
+                " (namespace TEXT, key TEXT, value BLOB, created_at REAL, PRIMARY KEY (namespace, key))"
+            )
+
+    def get(self, *key):
+        """
+        returns the cached value or None
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value, created_at FROM cache WHERE namespace = ? AND key = ?", (self.namespace, json.dumps(key))
+            ).fetchone()
+        if row is None or row[1] + self.ttl < time.time():
+            return None
+        return pickle.loads(row[0])
+
+    def set(self, *key, value):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (self.namespace, json.dumps(key), pickle.dumps(value), time.time()),
+            )
+
+    def clear(self):
+        with self.lock, self.conn:
+            deleted = self.conn.execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,)).rowcount
+        logger.info(f"cache: cleared {deleted} entries")
+
+
+class LRUCache:
+    """
+    in-memory cache which evicts least recently used entries over maxsize, safe between threads
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while self.maxsize < len(self.entries):
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,117 @@
+import zeep
+
+# fields of settings which are not compared
+# a name matches the field at any depth, a dotted path matches only the field at the path
+IGNORED_FIELDS = {"xsi_type"}
+# the server rewrites these after creation
+LINEITEM_IGNORED_FIELDS = IGNORED_FIELDS | {"startDateTimeType"}
+
+
+def canonical_custom_targeting(custom_targeting):
+    """
+    customTargeting in the form the server stores: an OR set of AND sets of criteria
+    the server wraps a criteria placed directly in the top level OR set in an AND set of its own
+    """
+    children = []
+    for child in custom_targeting.get("children") or []:
+        if "children" in child:
+            children.append(child)
+        else:
+            children.append({"xsi_type": "CustomCriteriaSet", "logicalOperator": "AND", "children": [child]})
+    return {**custom_targeting, "children": children}
+
+
+def compare_objects(key, settings: list, existing, ignore=IGNORED_FIELDS):
+    """
+    compare settings to existing by key
+    and returns
+    {
+        notfound: [...],
+        different: [...],
+        existing: [...],
+    }
+    each existing object is normalized once, only when it is compared
+    """
+    returns = {"notfound": [], "different": [], "existing": []}
+    existing_map = {e[key]: e for e in existing}
+    normalized = {}
+    for s in settings:
+        rel = s[key]
+        if rel in existing_map:
+            if rel not in normalized:
+                normalized[rel] = normalize(existing_map[rel])
+            if len(differences(s, normalized[rel], ignore)) == 0:
+                returns["existing"].append(s)
+            else:
+                returns["different"].append(s)
+        else:
+            returns["notfound"].append(s)
+    return returns
+
+
+def is_containing(setting, existing, ignore=IGNORED_FIELDS):
+    return len(differences(setting, normalize(existing), ignore)) == 0
+
+
+def normalize(obj):
+    """
+    serialize a SOAP object into plain dicts and lists without None values
+    customTargeting of a lineitem is put in the canonical form, so it compares by meaning and not by shape
+    """
+    normalized = _strip(zeep.helpers.serialize_object(obj, dict))
+    targeting = normalized.get("targeting") if isinstance(normalized, dict) else None
+    if isinstance(targeting, dict) and "customTargeting" in targeting:
+        targeting["customTargeting"] = canonical_custom_targeting(targeting["customTargeting"])
+    return normalized
+
+
+def _strip(value):
+    if isinstance(value, dict):
+        return {k: _strip(v) for k, v in value.items() if v is not None}
+    if isinstance(value, list):
+        return [_strip(v) for v in value]
+    return value
+
+
+def differences(setting, existing, ignore=IGNORED_FIELDS, path=""):
+    """
+    returns dotted paths of fields in setting which are not contained in existing (normalized)
+    """
+    if isinstance(setting, dict):
+        if not isinstance(existing, dict):
+            return [path]
+        diffs = []
+        for k, v in setting.items():
+            field = f"{path}.{k}" if path else k
+            if k in ignore or field in ignore:
+                continue
+            if k not in existing:
+                diffs.append(field)
+            else:
+                diffs += differences(v, existing[k], ignore, field)
+        return diffs
+    if isinstance(setting, list):
+        if not isinstance(existing, list) or len(setting) != len(existing):
+            return [path]
+        diffs = []
+        for i, (s, e) in enumerate(zip(setting, existing)):
+            diffs += differences(s, e, ignore, f"{path}[{i}]")
+        return diffs
+    return [] if setting == existing else [path]
+
+
+def apply_differences(obj, setting, diffs):
+    """
+    overwrite fields of obj (a SOAP object or dict) at the paths returned by differences with values of setting
+    a list is overwritten as a whole, fields not in diffs are kept as they are (e.g. set on the server)
+    """
+    for path in diffs:
+        target, source = obj, setting
+        segments = path.split(".")
+        for i, segment in enumerate(segments):
+            field = segment.split("[")[0]
+            if i == len(segments) - 1 or "[" in segment:
+                target[field] = source[field]
+                break
+            target, source = target[field], source[field]
+    return obj
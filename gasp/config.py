@@ -6,7 +6,19 @@ _root = os.path.normpath(os.path.dirname(os.path.abspath(__file__)) + "/..")
 
 class Config:
 
-    defaults = {}
+    defaults = {
+        "ad_manager": {
+            "rate_limit": {"requests_per_second": 1, "burst": 5},
+            "retry": {"max_retries": 5, "backoff_base": 2},
+            "batch_size": {"lineitem": 100, "creative": 100, "lineitemcreativeassociation": 20},
+            "lookup_cache_size": 10000,
+            # path None is the default location of zeep
+            "wsdl_cache": {"path": None, "ttl": 30 * 24 * 60 * 60},
+        },
+        "cache": {"path": None, "ttl": 24 * 60 * 60},
+        "state": {"path": "./gasp_state.json"},
+        "journal": {"path": "./gasp_journal.jsonl"},
+    }
 
     def __init__(self, path):
         self.path = path
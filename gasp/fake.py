@@ -0,0 +1,261 @@
+"""
+in-process fakes of Ad Manager and Sheets API for benchmarks and offline runs
+
+    client = FakeAdManagerClient(latency=0.05)
+    client.add("companies", name="Advertiser")
+    client.fail("LineItemService", "createLineItems", "ServerError.SERVER_ERROR", applied=True)
+    AdManager(config, client=client)
+"""
+import copy
+import itertools
+import re
+import threading
+from collections import Counter, deque
+from time import sleep
+from types import SimpleNamespace
+
+from googleads.errors import GoogleAdsServerFault
+
+from gasp.compare import canonical_custom_targeting
+
+# method -> collection of objects it reads or writes
+SERVICES = {
+    "CompanyService": {"getCompaniesByStatement": "companies"},
+    "UserService": {"getUsersByStatement": "users"},
+    "OrderService": {"getOrdersByStatement": "orders", "createOrders": "orders"},
+    "LineItemService": {
+        "getLineItemsByStatement": "lineitems",
+        "createLineItems": "lineitems",
+        "updateLineItems": "lineitems",
+    },
+    "CreativeService": {"getCreativesByStatement": "creatives", "createCreatives": "creatives"},
+    "CustomTargetingService": {
+        "getCustomTargetingKeysByStatement": "keys",
+        "getCustomTargetingValuesByStatement": "values",
+    },
+    "LineItemCreativeAssociationService": {
+        "getLineItemCreativeAssociationsByStatement": "licas",
+        "createLineItemCreativeAssociations": "licas",
+        "updateLineItemCreativeAssociations": "licas",
+    },
+}
+
+# collection -> (fields unique together, field of the request in fieldPath of errors)
+UNIQUE_KEYS = {
+    "orders": (("name",), "orders"),
+    "lineitems": (("orderId", "name"), "lineItems"),
+    "creatives": (("advertiserId", "name"), "creatives"),
+    "licas": (("lineItemId", "creativeId"), "lineItemCreativeAssociations"),
+}
+
+
+class FakeAdManagerClient:
+    """
+    stands in for AdManagerClient, objects are plain dicts kept in memory
+    every call sleeps `latency` seconds and is counted in `calls` by (service, method)
+    a create call is rejected as a whole with UniqueError.NOT_UNIQUE when an item duplicates another object
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.data = {c: [] for methods in SERVICES.values() for c in methods.values()}
+        self.calls = Counter()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.faults = {}
+
+    def GetService(self, service_name, version=None):
+        return FakeService(self, service_name)
+
+    def fail(self, service_name, method, error, applied=False, field=None, indexes=(), skip=0, times=1):
+        """
+        the method raises GoogleAdsServerFault of error `times` times after `skip` successful calls
+        with applied, the call is applied before the fault, like a server error after the commit
+        with field and indexes, errors point items of the request, e.g. "lineItemCreativeAssociations[3]"
+        """
+        fault = SimpleNamespace(error=error, applied=applied, field=field, indexes=indexes)
+        with self.lock:
+            self.faults.setdefault((service_name, method), deque()).extend([None] * skip + [fault] * times)
+
+    def next_fault(self, service_name, method):
+        with self.lock:
+            queue = self.faults.get((service_name, method))
+            return queue.popleft() if queue else None
+
+    def add(self, collection, **fields):
+        with self.lock:
+            obj = {"id": next(self.ids), **fields}
+            self.data[collection].append(obj)
+        return obj
+
+
+class FakeService:
+    def __init__(self, client, service_name):
+        self.client = client
+        self.service_name = service_name
+
+    def __getattr__(self, method):
+        if method not in SERVICES[self.service_name]:
+            raise AttributeError(f"{self.service_name}.{method} is not faked")
+        collection = SERVICES[self.service_name][method]
+
+        def call(arg):
+            with self.client.lock:
+                self.client.calls[(self.service_name, method)] += 1
+            sleep(self.client.latency)
+            fault = self.client.next_fault(self.service_name, method)
+            if fault is not None and not fault.applied:
+                raise server_fault(fault.error, fault.field, fault.indexes)
+            if method.endswith("ByStatement"):
+                response = self.query(collection, arg)
+            elif method.startswith("create"):
+                response = self.create(collection, arg)
+            else:
+                response = self.update(collection, arg)
+            if fault is not None:
+                raise server_fault(fault.error, fault.field, fault.indexes)
+            return response
+
+        return call
+
+    def query(self, collection, statement):
+        conditions, limit, offset = parse_statement(statement)
+        with self.client.lock:
+            matched = [o for o in self.client.data[collection] if all(match(o, *c) for c in conditions)]
+        # copies like deserialized responses, so changes by the caller are not written without an update call
+        end = offset + limit
+        results = copy.deepcopy(matched[offset:end])
+        return {"totalResultSetSize": len(matched), "startIndex": offset, "results": results}
+
+    def create(self, collection, objects):
+        fields, field_path = UNIQUE_KEYS[collection]
+        with self.client.lock:
+            keys = {unique_key(o, fields) for o in self.client.data[collection]}
+            duplicates = []
+            for i, obj in enumerate(objects):
+                if unique_key(obj, fields) in keys:
+                    duplicates.append(i)
+                keys.add(unique_key(obj, fields))
+            if 0 < len(duplicates):
+                raise server_fault("UniqueError.NOT_UNIQUE", field_path, duplicates)
+            created = [{"id": next(self.client.ids), **stored(obj)} for obj in objects]
+            self.client.data[collection] += created
+            return copy.deepcopy(created)
+
+    def update(self, collection, objects):
+        with self.client.lock:
+            by_id = {o["id"]: o for o in self.client.data[collection]}
+            for obj in objects:
+                by_id[obj["id"]].update(stored(obj))
+            return [copy.deepcopy(by_id[obj["id"]]) for obj in objects]
+
+
+def server_fault(error, field=None, indexes=()):
+    """
+    GoogleAdsServerFault like the one googleads raises, errors have fieldPath and errorString
+    """
+    paths = [f"{field}[{i}]" for i in indexes] if field is not None else [""]
+    errors = [SimpleNamespace(fieldPath=path, errorString=error) for path in paths]
+    message = ", ".join(f"{e.errorString} @ {e.fieldPath}" for e in errors)
+    return GoogleAdsServerFault(None, errors=errors, message=f"[{message}]")
+
+
+def unique_key(obj, fields):
+    return tuple(obj.get(f) for f in fields)
+
+
+def stored(obj):
+    """
+    an object as the server stores it, customTargeting of a lineitem is normalized like the real server
+    """
+    obj = copy.deepcopy(obj)
+    targeting = obj.get("targeting")
+    if targeting is not None and targeting.get("customTargeting") is not None:
+        targeting["customTargeting"] = canonical_custom_targeting(targeting["customTargeting"])
+    return obj
+
+
+def parse_statement(statement):
+    """
+    parse a statement of StatementBuilder.ToStatement() which consists of `=` and `IN` joined by AND
+    returns ([(field, [values])], limit, offset)
+    """
+    query = statement["query"]
+    binds = {v["key"]: unwrap(v["value"]) for v in statement.get("values") or []}
+
+    conditions = []
+    where = re.search(r"WHERE (.+?)(?: LIMIT | OFFSET |$)", query, re.I)
+    for cond in re.split(r"\s+AND\s+", where.group(1).strip(), flags=re.I) if where else []:
+        m = re.fullmatch(r"(\w+)\s+IN\s+\(:(\w+)\)|(\w+)\s*=\s*:(\w+)", cond.strip(), re.I)
+        if m is None:
+            raise NotImplementedError(f"unsupported condition: {cond}")
+        field, bind = (m.group(1), m.group(2)) if m.group(1) else (m.group(3), m.group(4))
+        values = binds[bind] if isinstance(binds[bind], list) else [binds[bind]]
+        conditions.append((field, set(map(str, values))))
+
+    limit = re.search(r"LIMIT (\d+)", query, re.I)
+    offset = re.search(r"OFFSET (\d+)", query, re.I)
+    return conditions, int(limit.group(1)) if limit else 500, int(offset.group(1)) if offset else 0
+
+
+def unwrap(value):
+    if "values" in value:
+        return [unwrap(v) for v in value["values"]]
+    return value["value"]
+
+
+def match(obj, field, values):
+    return str(obj.get(field)) in values
+
+
+class FakeSpreadsheets:
+    """
+    stands in for spreadsheets() resource of Sheets API v4
+    sheets: {sheet_name: [[cell, ...], ...]}
+    """
+
+    def __init__(self, sheets, latency=0.0):
+        self.sheets = sheets
+        self.latency = latency
+        self.calls = Counter()
+
+    def get(self, spreadsheetId, fields=None):
+        properties = [
+            {"title": name, "gridProperties": {"rowCount": len(rows), "columnCount": max(map(len, rows), default=0)}}
+            for name, rows in self.sheets.items()
+        ]
+        return self.request("get", {"sheets": [{"properties": p} for p in properties]})
+
+    def values(self):
+        return FakeValues(self)
+
+    def value_range(self, range):
+        m = re.fullmatch(r"'(.+)'!A(\d+):[A-Z]+(\d+)", range)
+        start, end = int(m.group(2)) - 1, int(m.group(3))
+        return {"range": range, "values": self.sheets[m.group(1)][start:end]}
+
+    def request(self, name, response):
+        self.calls[name] += 1
+        return FakeRequest(response, self.latency)
+
+
+class FakeValues:
+    def __init__(self, spreadsheets):
+        self.spreadsheets = spreadsheets
+
+    def get(self, range, **kwargs):
+        return self.spreadsheets.request("values.get", self.spreadsheets.value_range(range))
+
+    def batchGet(self, ranges, **kwargs):
+        value_ranges = [self.spreadsheets.value_range(r) for r in ranges]
+        return self.spreadsheets.request("values.batchGet", {"valueRanges": value_ranges})
+
+
+class FakeRequest:
+    def __init__(self, response, latency):
+        self.response = response
+        self.latency = latency
+
+    def execute(self):
+        sleep(self.latency)
+        return self.response
@@ -0,0 +1,74 @@
+import json
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Recorder:
+    """
+    records every API call (service, method, items, latency, retries, payload size) in the current phase
+    a record is a small tuple appended under a lock, cheap enough to be always on
+    """
+
+    FIELDS = ["phase", "service", "method", "items", "latency", "retries", "payload_size"]
+
+    def __init__(self):
+        self.records = []
+        self.current_phase = None
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        previous, self.current_phase = self.current_phase, name
+        try:
+            yield
+        finally:
+            self.current_phase = previous
+
+    def record(self, service, method, items, latency, retries=0, payload_size=0):
+        with self.lock:
+            self.records.append((self.current_phase, service, method, items, latency, retries, payload_size))
+
+    def summary(self):
+        """
+        call counts and p50/p95 latency per phase and method
+        """
+        groups = OrderedDict()
+        for phase, service, method, items, latency, retries, payload_size in list(self.records):
+            group = groups.setdefault(phase, OrderedDict()).setdefault(f"{service}.{method}", [])
+            group.append((latency, items, retries, payload_size))
+
+        lines = []
+        for phase, methods in groups.items():
+            calls = sum(len(g) for g in methods.values())
+            elapsed = sum(r[0] for g in methods.values() for r in g)
+            lines.append(f"{phase}: {calls} calls, {elapsed:.2f}s")
+            for name, group in methods.items():
+                latencies = sorted(r[0] for r in group)
+                lines.append(
+                    f"  {name}: {len(group)} calls, {sum(r[1] for r in group)} items, "
+                    f"p50 {percentile(latencies, 0.5) * 1000:.0f}ms, p95 {percentile(latencies, 0.95) * 1000:.0f}ms, "
+                    f"retries {sum(r[2] for r in group)}, payload {sum(r[3] for r in group)} bytes"
+                )
+        return "\n".join(lines)
+
+    def export(self, path):
+        with open(path, "w") as f:
+            json.dump([dict(zip(self.FIELDS, r)) for r in self.records], f)
+
+
+def percentile(sorted_values, q):
+    if len(sorted_values) == 0:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+def count_items(value):
+    """
+    number of objects sent or received in a call
+    """
+    if isinstance(value, (list, tuple)):
+        return len(value)
+    if value is not None and "results" in value:
+        return len(value["results"])
+    return 1
@@ -0,0 +1,121 @@
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class Journal:
+    """
+    checkpoints of a run, ids of lineitems and creatives per name and LICA pairs provisioned so far
+    a line is appended after every successful batch, so writing it costs only the batch itself
+    with resume, the journal of the crashed run is replayed and batches recorded in it are not queried again
+    the journal is removed when the run finished
+    """
+
+    def __init__(self, path, scope, resume=False):
+        self.path = path
+        self.scope = scope
+        self.lineitems = {}
+        self.creatives = {}
+        self.associations = set()
+        self.lock = threading.Lock()
+
+        if resume and os.path.exists(path):
+            self.load()
+        else:
+            with open(path, "w") as f:
+                f.write(json.dumps({"scope": scope}) + "\n")
+
+    def load(self):
+        with open(self.path) as f:
+            lines = f.readlines()
+        header = json.loads(lines[0]) if 0 < len(lines) else {}
+        if header.get("scope") != self.scope:
+            logger.info(f"journal: {self.path} is for another scope, ignored")
+            with open(self.path, "w") as f:
+                f.write(json.dumps({"scope": self.scope}) + "\n")
+            return
+
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line may be cut by the crash
+                continue
+            if entry["type"] == "lineitems":
+                self.lineitems.setdefault(entry["order_name"], {}).update(entry["ids"])
+            elif entry["type"] == "creatives":
+                self.creatives.update(entry["ids"])
+            elif entry["type"] == "associations":
+                self.associations.update(map(tuple, entry["pairs"]))
+        logger.info(
+            f"journal: resuming with {sum(map(len, self.lineitems.values()))} lineitems, "
+            f"{len(self.creatives)} creatives, {len(self.associations)} lineitem creative associations"
+        )
+
+    def append(self, entry):
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def record_lineitems(self, order_name, ids):
+        """
+        ids: {name: id}
+        """
+        if len(ids) == 0:
+            return
+        with self.lock:
+            self.lineitems.setdefault(order_name, {}).update(ids)
+        self.append({"type": "lineitems", "order_name": order_name, "ids": ids})
+
+    def record_creatives(self, ids):
+        """
+        ids: {name: id}
+        """
+        if len(ids) == 0:
+            return
+        with self.lock:
+            self.creatives.update(ids)
+        self.append({"type": "creatives", "ids": ids})
+
+    def record_associations(self, pairs):
+        """
+        pairs: [(lineitem_id, creative_id), ...]
+        """
+        if len(pairs) == 0:
+            return
+        with self.lock:
+            self.associations.update(pairs)
+        self.append({"type": "associations", "pairs": list(pairs)})
+
+    def seed_lineitems(self, ids):
+        """
+        ids: {order_name: {name: id}} known before the run (e.g. by gasp.state), kept in memory only
+        """
+        with self.lock:
+            for order_name, by_name in ids.items():
+                self.lineitems.setdefault(order_name, {}).update(by_name)
+
+    def lineitem_ids(self, order_name, names):
+        """
+        returns {name: id} when all names are recorded, otherwise None
+        """
+        recorded = self.lineitems.get(order_name, {})
+        if all(name in recorded for name in names):
+            return {name: recorded[name] for name in names}
+        return None
+
+    def creative_ids(self, names):
+        """
+        returns {name: id} when all names are recorded, otherwise None
+        """
+        if all(name in self.creatives for name in names):
+            return {name: self.creatives[name] for name in names}
+        return None
+
+    def discard(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
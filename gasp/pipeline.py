@@ -0,0 +1,68 @@
+import logging
+
+from gasp.admanager import association_settings, group_by, lineitem_sizes, run_per_order
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class Pipeline:
+    """
+    provision order by order: lineitems, creatives, then LICAs of the order right away
+    ids returned by create calls are used as they are, so nothing just created is queried again
+    with workers > 1, orders run concurrently and the API latency of an order overlaps with the others
+    """
+
+    def __init__(self, admanager, config):
+        self.admanager = admanager
+
+    def run(self, order_rows=[], lineitem_rows=[], creative_rows=[], workers=1, update=False):
+        """
+        returns ids resolved on the way
+        {orders: {name: id}, lineitems: {order_name: {name: id}}, creatives: {name: id}}
+        """
+        self.admanager.prefetch_key_values(lineitem_rows)
+        lineitem_rows_by_order = group_by("order_name", lineitem_rows)
+        creative_rows_by_order = group_by("order_name", creative_rows)
+        order_to_advertiser = {o["name"]: o["advertiser_name"] for o in order_rows}
+
+        def setup_order(order_row):
+            name = order_row["name"]
+            return self.setup_order(
+                order_row,
+                lineitem_rows_by_order.get(name, []),
+                creative_rows_by_order.get(name, []),
+                order_to_advertiser,
+                update,
+            )
+
+        ids = {"orders": {}, "lineitems": {}, "creatives": {}}
+        for name, (order_id, lineitem_ids, creative_ids) in run_per_order(order_rows, setup_order, workers).items():
+            ids["orders"][name] = order_id
+            ids["lineitems"][name] = lineitem_ids
+            ids["creatives"].update(creative_ids)
+        return ids
+
+    def setup_order(self, order_row, lineitem_rows, creative_rows, order_to_advertiser, update=False):
+        """
+        returns (order id, {lineitem name: id}, {creative name: id})
+        """
+        am = self.admanager
+        order = am.find_order(order_row["name"])
+        lineitems = am.provision_lineitems(order, lineitem_rows, update)
+        lineitem_to_sizes = lineitem_sizes(lineitem_rows)
+        creatives = am.provision_creatives(creative_rows, order_to_advertiser, lineitem_to_sizes)
+
+        lineitem_ids, creative_ids = lineitems["ids"], creatives["ids"]
+        # lineitems created just now have no LICA yet, only the others are queried
+        counts = am.provision_associations(
+            association_settings(creative_rows, lineitem_ids, creative_ids, lineitem_to_sizes),
+            new_lineitem_ids={lineitem_ids[name] for name in lineitems["created"]},
+        )
+
+        logger.info(
+            f'order {order["name"]}: lineitems {len(lineitem_ids)} (created {len(lineitems["created"])}), '
+            f'creatives {len(creative_ids)} (created {len(creatives["created"])}), '
+            f"lineitem creative associations created {counts['created']}"
+        )
+        return order["id"], lineitem_ids, creative_ids
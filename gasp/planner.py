@@ -0,0 +1,173 @@
+import json
+import logging
+from pprint import pformat
+
+from gasp.admanager import (
+    ExistingDifferentObject,
+    ObjectNotFound,
+    association_config,
+    association_pairs,
+    group_by,
+    index_by,
+    keyvalue_pairs,
+    lineitem_sizes,
+    lineitem_updates,
+)
+from gasp.compare import LINEITEM_IGNORED_FIELDS, compare_objects
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class Planner:
+    """
+    plan every write from the sheet rows against existing objects fetched in bulk, then apply the plan
+    nothing is written when the plan has errors or conflicts
+    """
+
+    def __init__(self, admanager, config):
+        self.admanager = admanager
+        # (lineitem, diffs) to send on apply, SOAP objects are not kept in the plan
+        self.updated_lineitems = []
+
+    def plan(self, order_rows=[], lineitem_rows=[], creative_rows=[], update=False):
+        """
+        with update, lineitems different from the sheet are planned as updates of the different fields, not conflicts
+        returns a JSON serializable plan
+        {
+            lineitems: {
+                create: [setting, ...], update: [{order_name, name, fields}, ...], skip: [...], conflict: [...]
+            },
+            creatives: {create: [setting, ...], skip: [...], conflict: [...]},
+            associations: {create: [{order_name, lineitem_name, creative_name, sizes}, ...], skip: [...]},
+            ids: {orders: {name: id}, lineitems: {order_name: {name: id}}, creatives: {name: id}},
+            errors: [...],
+        }
+        """
+        am = self.admanager
+        plan = {
+            "lineitems": {"create": [], "update": [], "skip": [], "conflict": []},
+            "creatives": {"create": [], "skip": [], "conflict": []},
+            "associations": {"create": [], "skip": []},
+            "ids": {"orders": {}, "lineitems": {}, "creatives": {}},
+            "errors": [],
+        }
+        ids = plan["ids"]
+        self.updated_lineitems = []
+
+        logger.info("plan: fetching orders")
+        order_names = list(map(lambda o: o["name"], order_rows))
+        orders = index_by("name", am.find_multi("OrderService", "getOrdersByStatement", "name", order_names))
+        for name, order in orders.items():
+            am.prime_lookup(order, "OrderService", "getOrdersByStatement", "name", name)
+            ids["orders"][name] = order["id"]
+        plan["errors"] += [f"order not found: {name}" for name in order_names if name not in orders]
+
+        # lineitems are compared by name in each order because uniqueness is in (order.name, lineitem.name) pairs
+        logger.info("plan: fetching lineitems")
+        plan["errors"] += [f"custom targeting not found: {m}" for m in am.resolve_key_values(lineitem_rows)]
+        # lineitems targeting missing keys or values are reported above and can not be compared
+        resolved_rows = [r for r in lineitem_rows if keyvalue_pairs(r) <= set(am.key_values.keys())]
+        existing_lineitems = group_by(
+            "orderId",
+            am.find_multi("LineItemService", "getLineItemsByStatement", "orderId", list(ids["orders"].values())),
+        )
+        for order_name, rows in group_by("order_name", resolved_rows).items():
+            if order_name not in orders:
+                continue
+            existing = existing_lineitems.get(orders[order_name]["id"], [])
+            settings = list(map(am.generate_lineitem_config, rows))
+            result = compare_objects("name", settings, existing, ignore=LINEITEM_IGNORED_FIELDS)
+            plan["lineitems"]["create"] += result["notfound"]
+            if update:
+                updates = lineitem_updates(result["different"], existing)
+                for lineitem, fields in updates:
+                    update_entry = {"order_name": order_name, "name": lineitem["name"], "fields": fields}
+                    plan["lineitems"]["update"].append(update_entry)
+                self.updated_lineitems += updates
+                result["different"] = []
+            for action, compared in [("skip", "existing"), ("conflict", "different")]:
+                plan["lineitems"][action] += [{"order_name": order_name, "name": s["name"]} for s in result[compared]]
+            ids["lineitems"][order_name] = {e["name"]: e["id"] for e in existing}
+
+        logger.info("plan: fetching creatives")
+        order_to_advertiser = {o["name"]: o["advertiser_name"] for o in order_rows}
+        lineitem_to_sizes = lineitem_sizes(lineitem_rows)
+        creative_rows = list(filter(lambda r: r["order_name"] in orders, creative_rows))
+        settings = am.creative_settings(creative_rows, order_to_advertiser, lineitem_to_sizes)
+        names = list(map(lambda s: s["name"], settings))
+        existing = list(am.find_multi("CreativeService", "getCreativesByStatement", "name", names))
+        result = compare_objects("name", settings, existing)
+        plan["creatives"]["create"] += result["notfound"]
+        plan["creatives"]["skip"] += list(map(lambda s: s["name"], result["existing"]))
+        plan["creatives"]["conflict"] += list(map(lambda s: s["name"], result["different"]))
+        ids["creatives"] = {e["name"]: e["id"] for e in existing}
+
+        logger.info("plan: fetching lineitem creative associations")
+        lineitem_ids = [i for by_name in ids["lineitems"].values() for i in by_name.values()]
+        existing = association_pairs(
+            am.find_multi(
+                "LineItemCreativeAssociationService",
+                "getLineItemCreativeAssociationsByStatement",
+                "lineItemId",
+                lineitem_ids,
+            )
+        )
+        for row in creative_rows:
+            association = {
+                "order_name": row["order_name"],
+                "lineitem_name": row["lineitem_name"],
+                "creative_name": row["name"],
+                "sizes": lineitem_to_sizes[(row["order_name"], row["lineitem_name"])],
+            }
+            lineitem_id = ids["lineitems"].get(row["order_name"], {}).get(row["lineitem_name"])
+            creative_id = ids["creatives"].get(row["name"])
+            if (lineitem_id, creative_id) in existing:
+                plan["associations"]["skip"].append(association)
+            else:
+                plan["associations"]["create"].append(association)
+
+        return plan
+
+    def apply(self, plan):
+        """
+        execute only the planned writes, ids returned by create calls are used for associations
+        """
+        if 0 < len(plan["errors"]):
+            raise ObjectNotFound("\n".join(plan["errors"]))
+        conflicts = {t: plan[t]["conflict"] for t in ["lineitems", "creatives"] if 0 < len(plan[t]["conflict"])}
+        if 0 < len(conflicts):
+            raise ExistingDifferentObject(pformat(conflicts))
+
+        am, ids = self.admanager, plan["ids"]
+        order_names = {order_id: name for name, order_id in ids["orders"].items()}
+
+        if 0 < len(plan["lineitems"]["update"]):
+            am.update_lineitems(self.updated_lineitems)
+
+        for lineitem in am.create_lineitems(plan["lineitems"]["create"], order_names):
+            ids["lineitems"].setdefault(order_names[lineitem["orderId"]], {})[lineitem["name"]] = lineitem["id"]
+        for creative in am.create_creatives(plan["creatives"]["create"]):
+            ids["creatives"][creative["name"]] = creative["id"]
+
+        settings = []
+        for association in plan["associations"]["create"]:
+            lineitem_id = ids["lineitems"][association["order_name"]][association["lineitem_name"]]
+            creative_id = ids["creatives"][association["creative_name"]]
+            settings.append(association_config(lineitem_id, creative_id, association["sizes"]))
+        # planned LICAs are compared already
+        am.provision_associations(settings, lookup=False)
+
+
+def summarize(plan):
+    lines = []
+    for object_type in ["lineitems", "creatives", "associations"]:
+        counts = ", ".join(f"{action} {len(objects)}" for action, objects in plan[object_type].items())
+        lines.append(f"{object_type}: {counts}")
+    lines += plan["errors"]
+    return "\n".join(lines)
+
+
+def export(plan, path):
+    with open(path, "w") as f:
+        json.dump(plan, f, ensure_ascii=False, indent=2, default=str)
@@ -3,30 +3,123 @@ from optparse import OptionParser
 
 from gasp.admanager import AdManager
 from gasp.config import Config
+from gasp.instrument import Recorder
+from gasp.journal import Journal
+from gasp.pipeline import Pipeline
+from gasp.planner import Planner, export, summarize
 from gasp.spreadsheet import Spreadsheet
+from gasp.state import SyncState
 
+logger = logging.getLogger("gasp.runner")
 
-def run(config_path):
+
+def run(
+    config_path,
+    workers=1,
+    refresh_cache=False,
+    plan=False,
+    dry_run=False,
+    plan_output=None,
+    incremental=False,
+    client=None,
+    sheets_api=None,
+    trace_output=None,
+    update=False,
+    resume=False,
+    pipeline=False,
+):
+    """
+    with plan (or dry_run), every write is planned against existing objects before any of them is sent
+    with incremental, only rows changed since the last successful run are processed
+    with update, existing lineitems are updated to the sheet instead of failing on differences
+    with pipeline, each order is provisioned at once (lineitems, creatives, LICAs) and workers overlap orders
+    every successful batch is checkpointed in the journal, with resume a crashed run continues from the journal
+    client and sheets_api replace the backends of Ad Manager and Sheets (e.g. gasp.fake)
+    every API call is recorded and summarized per phase at the end, trace_output exports them as JSON
+    """
     config = Config(config_path)
 
-    admanager = AdManager(config)
-    spreadsheet = Spreadsheet(config)
+    scope = f'{config.get("ad_manager.network_code")}:{config.get("spreadsheet.id")}'
+    recorder = Recorder()
+    # a dry run must not truncate the journal of a crashed run
+    journal = None if dry_run else Journal(config.get_or_default("journal.path"), scope, resume=resume)
+    admanager = AdManager(config, refresh_cache=refresh_cache, client=client, recorder=recorder, journal=journal)
+    spreadsheet = Spreadsheet(config, api=sheets_api, recorder=recorder)
 
-    spreadsheet.check_settings()
+    try:
+        with recorder.phase("check_settings"):
+            spreadsheet.check_settings()
+        order_rows = spreadsheet.fetch_rows("order")
+        lineitem_rows = spreadsheet.fetch_rows("lineitem")
+        creative_rows = spreadsheet.fetch_rows("creative")
+
+        state = None
+        if incremental:
+            state = SyncState(config.get_or_default("state.path"), scope)
+            order_rows, lineitem_rows, creative_rows = state.changed_rows(order_rows, lineitem_rows, creative_rows)
+            if journal is not None:
+                # unchanged lineitems are resolved by their recorded ids instead of lookups
+                journal.seed_lineitems(state.unchanged_lineitem_ids(lineitem_rows))
+
+        if plan or dry_run:
+            ids = run_planned(
+                config, admanager, order_rows, lineitem_rows, creative_rows, dry_run, plan_output, update
+            )
+        elif pipeline:
+            with recorder.phase("pipeline"):
+                ids = Pipeline(admanager, config).run(
+                    order_rows=order_rows,
+                    lineitem_rows=lineitem_rows,
+                    creative_rows=creative_rows,
+                    workers=workers,
+                    update=update,
+                )
+        else:
+            with recorder.phase("setup_lineitems"):
+                admanager.setup_lineitems(
+                    order_rows=order_rows, lineitem_rows=lineitem_rows, workers=workers, update=update
+                )
+            with recorder.phase("setup_creatives"):
+                admanager.setup_creatives(
+                    creative_rows=creative_rows, order_rows=order_rows, lineitem_rows=lineitem_rows
+                )
+            with recorder.phase("setup_lineitemassociation"):
+                ids = admanager.setup_lineitemassociation(
+                    order_rows=order_rows, lineitem_rows=lineitem_rows, creative_rows=creative_rows
+                )
+
+        if state is not None and ids is not None:
+            state.record_all(order_rows, lineitem_rows, creative_rows, ids)
+            state.save()
+        if journal is not None:
+            journal.discard()
+    finally:
+        admanager.report_cache_stats()
+        logger.info(f"api calls:\n{recorder.summary()}")
+        if trace_output is not None:
+            recorder.export(trace_output)
 
-    admanager.setup_lineitems(
-        order_rows=spreadsheet.fetch_rows("order"), lineitem_rows=spreadsheet.fetch_rows("lineitem")
-    )
-    admanager.setup_creatives(
-        creative_rows=spreadsheet.fetch_rows("creative"),
-        order_rows=spreadsheet.fetch_rows("order"),
-        lineitem_rows=spreadsheet.fetch_rows("lineitem"),
-    )
-    admanager.setup_lineitemassociation(
-        order_rows=spreadsheet.fetch_rows("order"),
-        lineitem_rows=spreadsheet.fetch_rows("lineitem"),
-        creative_rows=spreadsheet.fetch_rows("creative"),
-    )
+
+def run_planned(
+    config, admanager, order_rows, lineitem_rows, creative_rows, dry_run=False, plan_output=None, update=False
+):
+    """
+    returns resolved ids, or None on dry run
+    """
+    planner = Planner(admanager, config)
+    with admanager.recorder.phase("plan"):
+        planned = planner.plan(
+            order_rows=order_rows, lineitem_rows=lineitem_rows, creative_rows=creative_rows, update=update
+        )
+    logger.info(f"plan:\n{summarize(planned)}")
+    if plan_output is not None:
+        export(planned, plan_output)
+        logger.info(f"plan: exported to {plan_output}")
+    if dry_run:
+        return None
+    with admanager.recorder.phase("apply"):
+        planner.apply(planned)
+    return planned["ids"]
 
 
 if __name__ == "__main__":
@@ -35,9 +128,39 @@ if __name__ == "__main__":
 
     parser = OptionParser()
     parser.add_option("--config", type="string", dest="config_path")
+    parser.add_option("--workers", type="int", dest="workers", default=1, help="provision orders concurrently")
+    parser.add_option("--refresh-cache", action="store_true", dest="refresh_cache", default=False)
+    parser.add_option("--plan", action="store_true", dest="plan", default=False, help="plan all writes before applying")
+    parser.add_option("--dry-run", action="store_true", dest="dry_run", default=False, help="plan only, write nothing")
+    parser.add_option("--plan-output", type="string", dest="plan_output", help="export the plan as JSON")
+    parser.add_option("--trace-output", type="string", dest="trace_output", help="export every API call as JSON")
+    parser.add_option(
+        "--incremental", action="store_true", dest="incremental", default=False, help="process changed rows only"
+    )
+    parser.add_option(
+        "--update", action="store_true", dest="update", default=False, help="update lineitems changed in the sheet"
+    )
+    parser.add_option(
+        "--resume", action="store_true", dest="resume", default=False, help="continue a crashed run from its journal"
+    )
+    parser.add_option(
+        "--pipeline", action="store_true", dest="pipeline", default=False, help="provision order by order"
+    )
     options, _ = parser.parse_args()
     if options.config_path is None:
         parser.print_help()
         exit()
 
-    run(options.config_path)
+    run(
+        options.config_path,
+        workers=options.workers,
+        refresh_cache=options.refresh_cache,
+        plan=options.plan,
+        dry_run=options.dry_run,
+        plan_output=options.plan_output,
+        incremental=options.incremental,
+        trace_output=options.trace_output,
+        update=options.update,
+        resume=options.resume,
+        pipeline=options.pipeline,
+    )
@@ -1,134 +1,237 @@
 import logging
+from time import monotonic
 
 import googleapiclient.discovery as discovery
 from google.oauth2 import service_account
-from jsonschema import validate
+from jsonschema import Draft7Validator
+
+from gasp.admanager import TARGETING_KEYVALUE_COLUMNS, GaspException
+from gasp.instrument import Recorder
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 # jsonschema parts
 non_empty_string = {"type": "string", "minLength": 1}
+single_keyvalue = {"type": "string", "pattern": "^(.+=.+)?$"}
+
+# validators are compiled once, order/lineitem names are checked by set lookups instead of enum
+order_validator = Draft7Validator(
+    {
+        "type": "object",
+        "properties": {
+            "name": non_empty_string,
+            "advertiser_name": non_empty_string,
+            "trafficker_name": non_empty_string,
+        },
+        "required": ["name", "advertiser_name", "trafficker_name"],
+    }
+)
+lineitem_validator = Draft7Validator(
+    {
+        "type": "object",
+        "properties": {
+            "order_name": {"type": "string"},
+            "name": non_empty_string,
+            "sizes": {"type": "string", "minLength": 1, "pattern": "^\\d+x\\d+(\\s?,\\s?\\d+x\\d+)*$"},
+            "costPerUnit": {"type": "integer", "minimum": 1},
+            "targetingUnit": {"type": "string", "minLength": 1, "pattern": "^(\\d+)(,\\d+)*$"},
+            **{c: single_keyvalue for c in TARGETING_KEYVALUE_COLUMNS},
+        },
+        "required": ["order_name", "name", "sizes", "costPerUnit", "targetingUnit"],
+    }
+)
+creative_validator = Draft7Validator(
+    {
+        "type": "object",
+        "properties": {
+            "order_name": {"type": "string"},
+            "lineitem_name": {"type": "string"},
+            "name": non_empty_string,
+            "snippet": non_empty_string,
+        },
+    }
+)
+
+
+def column_letter(n):
+    """
+    1 -> "A", 26 -> "Z", 27 -> "AA"
+    """
+    letters = ""
+    while 0 < n:
+        n, rem = divmod(n - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return letters
 
 
 class Spreadsheet:
 
     SCOPES = ["https://www.googleapis.com/auth/spreadsheets.readonly"]
 
-    def __init__(self, config):
-        credentials = service_account.Credentials.from_service_account_file(config.get("key"), scopes=self.SCOPES)
-        service = discovery.build("sheets", "v4", credentials=credentials)
+    def __init__(self, config, api=None, recorder=None):
+        """
+        api: spreadsheets() resource of Sheets API v4 (or gasp.fake.FakeSpreadsheets)
+        recorder: gasp.instrument.Recorder which records every Sheets request
+        """
+        self.recorder = recorder if recorder is not None else Recorder()
+        if api is None:
+            credentials = service_account.Credentials.from_service_account_file(config.get("key"), scopes=self.SCOPES)
+            api = discovery.build("sheets", "v4", credentials=credentials).spreadsheets()
 
         self.config = config
-        self.api = service.spreadsheets()
+        self.api = api
         self.getopts = {
             "spreadsheetId": config.get("spreadsheet.id"),
             "majorDimension": "ROWS",
             "valueRenderOption": "UNFORMATTED_VALUE",
         }
         self.cache = {}
+        self.row_numbers = {}
 
     def fetch_rows(self, sheet_type):
-        if sheet_type in self.cache:
-            return self.cache[sheet_type]
-
-        sheet_config = self.config.get_or_default(f"spreadsheet.sheets.{sheet_type}")
-        assert sheet_type in self.config.get_or_default("spreadsheet.sheets").keys()
-
-        rows = []
-
-        hasNext, page, rows_per_req = True, 0, 1000
-        while hasNext:
-            start, end = page * rows_per_req + 1, (page + 1) * rows_per_req
-            range = f"'{sheet_config['sheet_name']}'!A{start}:R{end}"
-
-            logger.info(f"fetching a sheet: {range}")
-            response = self.api.values().get(range=range, **self.getopts).execute()  # check failure
-            rows.extend(response["values"])
-            page += 1
-            if len(response["values"]) < rows_per_req:
-                hasNext = False
+        if sheet_type not in self.cache:
+            self.fetch_sheets([sheet_type])
+        return self.cache[sheet_type]
 
+    def fetch_sheets(self, sheet_types):
+        """
+        fetch sheets at once by values().batchGet, ranges are sized by gridProperties of each sheet
+        """
+        sheet_types = [t for t in sheet_types if t not in self.cache]
+        if len(sheet_types) == 0:
+            return
+        assert set(sheet_types) <= self.config.get_or_default("spreadsheet.sheets").keys()
+        sheet_configs = {t: self.config.get_or_default(f"spreadsheet.sheets.{t}") for t in sheet_types}
+
+        grids = self.fetch_grid_properties()
+        ranges = []
+        for sheet_type, sheet_config in sheet_configs.items():
+            grid = grids[sheet_config["sheet_name"]]
+            ranges.append(f"'{sheet_config['sheet_name']}'!A1:{column_letter(grid['columnCount'])}{grid['rowCount']}")
+
+        logger.info(f"fetching sheets: {', '.join(ranges)}")
+        response = self.execute("values.batchGet", self.api.values().batchGet(ranges=ranges, **self.getopts))
+        for sheet_type, value_range in zip(sheet_configs.keys(), response["valueRanges"]):
+            models, row_numbers = self.to_models(sheet_configs[sheet_type], value_range.get("values", []))
+            self.cache[sheet_type], self.row_numbers[sheet_type] = models, row_numbers
+
+    def fetch_grid_properties(self):
+        """
+        returns {sheet_name: {rowCount: int, columnCount: int}}
+        """
+        fields = "sheets.properties(title,gridProperties)"
+        response = self.execute("get", self.api.get(spreadsheetId=self.getopts["spreadsheetId"], fields=fields))
+        return {s["properties"]["title"]: s["properties"]["gridProperties"] for s in response["sheets"]}
+
+    def execute(self, method, request):
+        start = monotonic()
+        response = request.execute()
+        rows = sum(len(r.get("values", [])) for r in response.get("valueRanges", []))
+        self.recorder.record("sheets", method, rows, monotonic() - start)
+        return response
+
+    def to_models(self, sheet_config, rows):
+        """
+        returns (models, row numbers of models in the sheet)
+        """
         # filter empty & comment
-        rows = list(filter(lambda r: len(r) != 0 and not r[0].startswith("#"), rows))
+        numbered = list(filter(lambda nr: len(nr[1]) != 0 and not nr[1][0].startswith("#"), enumerate(rows, 1)))
 
         # rows to dict
-        header, mapping = rows.pop(0), {}
+        (_, header), mapping = numbered.pop(0), {}
         for key, name in sheet_config["columns"].items():
             mapping[key] = header.index(name)
-        models = map(lambda r: {k: r[idx] if idx < len(r) else "" for k, idx in mapping.items()}, rows)
-
-        self.cache[sheet_type] = list(models)
-        return self.cache[sheet_type]
+        models = map(lambda nr: {k: nr[1][idx] if idx < len(nr[1]) else "" for k, idx in mapping.items()}, numbered)
+        return list(models), list(map(lambda nr: nr[0], numbered))
 
     def check_settings(self):
+        """
+        validate all sheets and raise InvalidSettings reporting every invalid row with its row number
+        """
         logger.info("check settings in the spreadsheet")
+        self.fetch_sheets(["order", "lineitem", "creative"])
 
         orders = self.fetch_rows("order")
-        self.check_orders(orders)
         lineitems = self.fetch_rows("lineitem")
-        self.check_lineitems(lineitems, orders)
         creatives = self.fetch_rows("creative")
-        self.check_creatives(creatives, orders, lineitems)
+        errors = {
+            "order": self.check_orders(orders),
+            "lineitem": self.check_lineitems(lineitems, orders),
+            "creative": self.check_creatives(creatives, orders, lineitems),
+        }
+
+        messages = []
+        for sheet_type, sheet_errors in errors.items():
+            sheet_name = self.config.get_or_default(f"spreadsheet.sheets.{sheet_type}.sheet_name")
+            for idx, message in sheet_errors:
+                messages.append(f"{sheet_name} row {self.row_numbers[sheet_type][idx]}: {message}")
+        if 0 < len(messages):
+            raise InvalidSettings(f"{len(messages)} invalid settings:\n" + "\n".join(messages))
 
     def check_orders(self, orders):
-        # check values
-        schema = {
-            "type": "object",
-            "properties": {
-                "name": non_empty_string,
-                "advertiser_name": non_empty_string,
-                "trafficker_name": non_empty_string,
-            },
-            "required": ["name", "advertiser_name", "trafficker_name"],
-        }
         logger.info("checking order settings")
-        [validate(o, schema) for o in orders]
-
+        errors = schema_errors(order_validator, orders)
         # name must be unique
-        names = list(map(lambda o: o["name"], orders))
-        assert len(set(names)) == len(names), "order name must be unique"
+        errors += duplicate_errors("order name must be unique", map(lambda o: o["name"], orders))
+        return errors
 
     def check_lineitems(self, lineitems, orders):
-        order_names = list(set(list(map(lambda o: o["name"], orders))))
-
-        single_keyvalue = {"type": "string", "pattern": "^(.+=.+)?$"}
-
-        schema = {
-            "type": "object",
-            "properties": {
-                "order_name": {"type": "string", "enum": order_names},
-                "name": non_empty_string,
-                "sizes": {"type": "string", "minLength": 1, "pattern": "^\\d+x\\d+(\\s?,\\s?\\d+x\\d+)*$"},
-                "costPerUnit": {"type": "integer", "minimum": 1},
-                "targetingUnit": {"type": "string", "minLength": 1, "pattern": "^(\\d+)(,\\d+)*$"},
-                **dict(map(lambda n: ("targetingKeyValue" + str(n), single_keyvalue), range(1, 12 + 1))),
-            },
-            "required": ["order_name", "name", "sizes", "costPerUnit", "targetingUnit"],
-        }
-        logger.info("checking lineitem settings")
-        [validate(li, schema) for li in lineitems]
+        order_names = set(map(lambda o: o["name"], orders))
 
+        logger.info("checking lineitem settings")
+        errors = schema_errors(lineitem_validator, lineitems)
+        errors += membership_errors("order_name", order_names, lineitems)
         # name must be unique in order
-        names = list(map(lambda li: li["name"] + li["order_name"], lineitems))
-        assert len(set(names)) == len(names), "lineitem name must be unique in order"
+        errors += duplicate_errors(
+            "lineitem name must be unique in order", map(lambda li: (li["order_name"], li["name"]), lineitems)
+        )
+        return errors
 
     def check_creatives(self, creatives, orders, lineitems):
-        order_names = list(set(list(map(lambda o: o["name"], orders))))
-        lineitem_names = list(set(list(map(lambda li: li["name"], lineitems))))
-
-        schema = {
-            "type": "object",
-            "properties": {
-                "order_name": {"type": "string", "enum": order_names},
-                "lineitem_name": {"type": "string", "enum": lineitem_names},
-                "name": non_empty_string,
-                "snippet": non_empty_string,
-            },
-        }
-        logger.info("checking creative settings")
-        [validate(c, schema) for c in creatives]
+        order_names = set(map(lambda o: o["name"], orders))
+        # lineitem names are unique only in each order
+        lineitem_keys = set(map(lambda li: (li["order_name"], li["name"]), lineitems))
 
+        logger.info("checking creative settings")
+        errors = schema_errors(creative_validator, creatives)
+        errors += membership_errors("order_name", order_names, creatives)
+        for idx, row in enumerate(creatives):
+            order_name, lineitem_name = row.get("order_name"), row.get("lineitem_name")
+            if order_name in order_names and (order_name, lineitem_name) not in lineitem_keys:
+                errors.append((idx, f"lineitem_name: {lineitem_name!r} is not defined in order {order_name!r}"))
         # name must be unique
-        names = list(map(lambda c: c["name"], creatives))
-        assert len(set(names)) == len(names), "creative name must be unique"
+        errors += duplicate_errors("creative name must be unique", map(lambda c: c["name"], creatives))
+        return errors
+
+
+def schema_errors(validator, rows):
+    """
+    returns [(index of row, message), ...]
+    """
+    errors = []
+    for idx, row in enumerate(rows):
+        for e in validator.iter_errors(row):
+            errors.append((idx, f"{'.'.join(map(str, e.path)) or 'row'}: {e.message}"))
+    return errors
+
+
+def membership_errors(field, names: set, rows):
+    errors = []
+    for idx, row in enumerate(rows):
+        if row.get(field) not in names:
+            errors.append((idx, f"{field}: {row.get(field)!r} is not defined"))
+    return errors
+
+
+def duplicate_errors(message, keys):
+    seen, errors = set(), []
+    for idx, key in enumerate(keys):
+        if key in seen:
+            errors.append((idx, message))
+        seen.add(key)
+    return errors
+
+
+class InvalidSettings(GaspException):
+    "There are invalid settings in the spreadsheet."
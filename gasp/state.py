@@ -0,0 +1,103 @@
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def fingerprint(row):
+    return hashlib.sha1(json.dumps(row, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+
+def row_key(sheet_type, row):
+    # lineitem names are unique in each order
+    if sheet_type == "lineitem":
+        return f'{row["order_name"]}\t{row["name"]}'
+    return row["name"]
+
+
+class SyncState:
+    """
+    fingerprints of sheet rows synced by previous runs and ids of lineitems they resolved to
+    the state is discarded when it was written for another network or spreadsheet (scope)
+    """
+
+    def __init__(self, path, scope):
+        self.path = path
+        self.scope = scope
+        self.rows = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get("scope") == scope:
+                self.rows = data["rows"]
+            else:
+                logger.info(f"state: {path} is for another scope, ignored")
+
+    def is_changed(self, sheet_type, row):
+        entry = self.rows.get(sheet_type, {}).get(row_key(sheet_type, row))
+        return entry is None or entry["hash"] != fingerprint(row)
+
+    def record(self, sheet_type, row, id=None):
+        self.rows.setdefault(sheet_type, {})[row_key(sheet_type, row)] = {"hash": fingerprint(row), "id": id}
+
+    def record_all(self, order_rows, lineitem_rows, creative_rows, ids):
+        """
+        ids: {orders: {name: id}, lineitems: {order_name: {name: id}}, creatives: {name: id}}
+        only lineitem ids are kept, an unchanged creative is processed only when its order or lineitem changed
+        and then it has to be compared again anyway
+        """
+        for row in order_rows:
+            self.record("order", row)
+        for row in lineitem_rows:
+            self.record("lineitem", row, ids["lineitems"].get(row["order_name"], {}).get(row["name"]))
+        for row in creative_rows:
+            self.record("creative", row)
+
+    def unchanged_lineitem_ids(self, lineitem_rows):
+        """
+        returns {order_name: {name: id}} of unchanged lineitems, e.g. lineitems referred by changed creatives
+        the config of a lineitem depends only on its row, so they need neither compare nor lookup
+        """
+        ids = {}
+        for row in lineitem_rows:
+            entry = self.rows.get("lineitem", {}).get(row_key("lineitem", row))
+            if entry is not None and entry["hash"] == fingerprint(row) and entry.get("id") is not None:
+                ids.setdefault(row["order_name"], {})[row["name"]] = entry["id"]
+        return ids
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"scope": self.scope, "rows": self.rows}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def changed_rows(self, order_rows, lineitem_rows, creative_rows):
+        """
+        returns (orders, lineitems, creatives) to process
+        rows depending on changed rows are processed too, e.g. creatives of a lineitem whose sizes changed,
+        and lineitems referred by changed creatives are kept to resolve their sizes
+        """
+        changed_orders = {o["name"] for o in order_rows if self.is_changed("order", o)}
+        lineitems = [
+            li for li in lineitem_rows if li["order_name"] in changed_orders or self.is_changed("lineitem", li)
+        ]
+        changed_lineitems = {(li["order_name"], li["name"]) for li in lineitems}
+        creatives = [
+            c
+            for c in creative_rows
+            if c["order_name"] in changed_orders
+            or (c["order_name"], c["lineitem_name"]) in changed_lineitems
+            or self.is_changed("creative", c)
+        ]
+        referred = {(c["order_name"], c["lineitem_name"]) for c in creatives} - changed_lineitems
+        lineitems += [li for li in lineitem_rows if (li["order_name"], li["name"]) in referred]
+        touched_orders = changed_orders | {r["order_name"] for r in lineitems + creatives}
+        orders = [o for o in order_rows if o["name"] in touched_orders]
+        logger.info(
+            f"state: changed orders {len(orders)}/{len(order_rows)}, lineitems {len(lineitems)}/{len(lineitem_rows)}, "
+            f"creatives {len(creatives)}/{len(creative_rows)}"
+        )
+        return orders, lineitems, creatives
@@ -0,0 +1,127 @@
+import copy
+import json
+from collections import Counter
+
+import pytest
+
+from benchmarks.bench_run import CONFIG, campaign
+from gasp.admanager import ProvisioningFailed
+from gasp.runner import run
+
+LINEITEMS = 250
+
+MODES = [
+    pytest.param({}, id="setup"),
+    pytest.param({"workers": 3}, id="setup-workers"),
+    pytest.param({"plan": True}, id="plan"),
+    pytest.param({"pipeline": True, "workers": 3}, id="pipeline"),
+]
+
+
+@pytest.fixture
+def config_path(tmp_path):
+    config = copy.deepcopy(CONFIG)
+    config["journal"] = {"path": str(tmp_path / "journal.jsonl")}
+    config["ad_manager"]["retry"] = {"backoff_base": 0.001}
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps(config))
+    return str(path)
+
+
+def writes(client):
+    return {k: n for k, n in client.calls.items() if not k[1].endswith("ByStatement")}
+
+
+def assert_provisioned(client, lineitems=LINEITEMS):
+    assert len(client.data["lineitems"]) == lineitems
+    assert len(client.data["creatives"]) == lineitems
+    assert len(client.data["licas"]) == lineitems
+    pairs = Counter((a["lineItemId"], a["creativeId"]) for a in client.data["licas"])
+    assert max(pairs.values()) == 1
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_rerun_writes_nothing(config_path, mode):
+    client, sheets = campaign(LINEITEMS, 0)
+    run(config_path, client=client, sheets_api=sheets, **mode)
+    assert_provisioned(client)
+
+    client.calls.clear()
+    run(config_path, client=client, sheets_api=sheets, **mode)
+    assert writes(client) == {}
+    assert_provisioned(client)
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_update_converges(config_path, mode):
+    client, sheets = campaign(LINEITEMS, 0)
+    run(config_path, client=client, sheets_api=sheets, **mode)
+    sheets.sheets["LineItem"][1][3] = 999
+
+    client.calls.clear()
+    run(config_path, client=client, sheets_api=sheets, update=True, **mode)
+    assert writes(client) == {("LineItemService", "updateLineItems"): 1}
+
+    client.calls.clear()
+    run(config_path, client=client, sheets_api=sheets, update=True, **mode)
+    assert writes(client) == {}
+
+
+@pytest.mark.parametrize("mode", [{}, {"pipeline": True}], ids=["setup", "pipeline"])
+def test_resume_does_not_query_recorded_objects(config_path, tmp_path, mode):
+    client, sheets = campaign(LINEITEMS, 0)
+    # the run crashes at the third batch of LICAs
+    client.fail(
+        "LineItemCreativeAssociationService",
+        "createLineItemCreativeAssociations",
+        "InternalApiError.UNEXPECTED_INTERNAL_API_ERROR",
+        skip=2,
+    )
+    with pytest.raises(ProvisioningFailed):
+        run(config_path, client=client, sheets_api=sheets, **mode)
+    assert (tmp_path / "journal.jsonl").exists()
+
+    client.calls.clear()
+    run(config_path, client=client, sheets_api=sheets, resume=True, **mode)
+    assert client.calls[("LineItemService", "getLineItemsByStatement")] == 0
+    assert client.calls[("CreativeService", "getCreativesByStatement")] == 0
+    assert set(writes(client)) == {("LineItemCreativeAssociationService", "createLineItemCreativeAssociations")}
+    assert_provisioned(client)
+    assert not (tmp_path / "journal.jsonl").exists()
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_lica_partial_failure(config_path, mode):
+    client, sheets = campaign(LINEITEMS, 0)
+    client.fail(
+        "LineItemCreativeAssociationService",
+        "createLineItemCreativeAssociations",
+        "RequiredError.REQUIRED",
+        field="lineItemCreativeAssociations",
+        indexes=[3],
+    )
+    with pytest.raises(ProvisioningFailed):
+        run(config_path, client=client, sheets_api=sheets, **mode)
+    # only the item pointed by the fault is dropped, the rest of the batch is sent again
+    assert len(client.data["licas"]) == LINEITEMS - 1
+
+    client.calls.clear()
+    run(config_path, client=client, sheets_api=sheets, resume=True, **mode)
+    assert writes(client) == {("LineItemCreativeAssociationService", "createLineItemCreativeAssociations"): 1}
+    assert_provisioned(client)
+
+
+@pytest.mark.parametrize("mode", MODES)
+@pytest.mark.parametrize(
+    "service_name, method",
+    [
+        ("LineItemService", "createLineItems"),
+        ("CreativeService", "createCreatives"),
+        ("LineItemCreativeAssociationService", "createLineItemCreativeAssociations"),
+    ],
+)
+def test_server_error_after_create_makes_no_duplicates(config_path, mode, service_name, method):
+    client, sheets = campaign(LINEITEMS, 0)
+    client.fail(service_name, method, "ServerError.SERVER_ERROR", applied=True)
+    run(config_path, client=client, sheets_api=sheets, **mode)
+    assert_provisioned(client)